@@ -0,0 +1,413 @@
+import os
+import asyncio
+import sys
+import time
+import random
+import shutil
+import tempfile
+import threading
+from datetime import datetime
+from datetime import timedelta
+
+from fridge import Fridge, UserStatus
+
+
+# Benchmarks for the performance sensitive parts of SalsaProvider. Run with: python benchmarks.py [benchmark names...]
+
+
+def _report(name, count, seconds):
+    print(f'{name}: {count} in {seconds:.3f}s ({count / seconds:,.0f}/s)')
+
+
+# utilities depends on discord, so it is only imported by the benchmarks which need it. salsa_settings must be imported
+# first, as importing utilities on its own runs into the circular import between the two
+def _import_utilities():
+    import salsa_settings  # noqa: F401
+    import utilities
+    return utilities
+
+
+# The alias ID lookup used before the in-memory alias map existed
+def _query_alias_id(fridge, user_id):
+    with fridge._connection:
+        while True:
+            alias_id = fridge._connection.execute('SELECT rowid FROM UserIDs WHERE id=?', (user_id,)).fetchone()
+            if alias_id is None:
+                fridge._connection.execute('INSERT INTO UserIDs VALUES (?)', (user_id,))
+            else:
+                return alias_id[0]
+
+
+# Throughput of Fridge.user_activity_update with and without the in-memory alias map. Write-behind is enabled so that
+# the per-update commit does not hide the cost of the alias lookup
+def bench_alias_map(updates=10000, users=500):
+    statuses = [status for status in UserStatus if status != UserStatus.Offline]
+
+    for use_map in (False, True):
+        with tempfile.TemporaryDirectory() as directory:
+            with Fridge(os.path.join(directory, 'bench.db'), write_behind=True) as fridge:
+                if not use_map:
+                    fridge.get_alias_id = lambda user_id: _query_alias_id(fridge, user_id)
+
+                random.seed(0)
+                timestamp = datetime(2024, 1, 1)
+                start = time.perf_counter()
+                for _ in range(updates):
+                    timestamp += timedelta(seconds=random.randint(0, 60))
+                    fridge.user_activity_update(random.randrange(users), random.choice(statuses), timestamp)
+                fridge.flush()
+
+                _report(f'user_activity_update ({"with" if use_map else "without"} alias map)', updates,
+                        time.perf_counter() - start)
+
+                start = time.perf_counter()
+                for _ in range(updates):
+                    fridge.get_alias_id(random.randrange(users))
+
+                _report(f'get_alias_id ({"with" if use_map else "without"} alias map)', updates,
+                        time.perf_counter() - start)
+
+
+# Create a db containing rows closed UserActivity entries, spread evenly among the given number of users
+def _create_activity_db(path, rows, users):
+    statuses = [status for status in UserStatus if status != UserStatus.Offline]
+    with Fridge(path, wal=False) as fridge:
+        for user_id in range(users):
+            fridge.get_alias_id(user_id)
+
+        random.seed(0)
+        start = round(datetime(2020, 1, 1).timestamp())
+        entries = ((index % users + 1, random.choice(statuses), start + index * 30, random.randint(1, 30 * users))
+                   for index in range(rows))
+        with fridge._connection:
+            fridge._connection.executemany('INSERT INTO UserActivity VALUES(?,?,?,?)', entries)
+
+
+# Activity summaries over a large db, and the latency of activity updates while those summaries are running on another
+# thread. Compares the rollback journal without connection tuning against WAL mode
+def bench_wal(rows=2000000, users=200, updates=200):
+    with tempfile.TemporaryDirectory() as directory:
+        template_path = os.path.join(directory, 'template.db')
+        _create_activity_db(template_path, rows, users)
+
+        for wal in (False, True):
+            path = os.path.join(directory, f'bench_{wal}.db')
+            shutil.copyfile(template_path, path)
+            mode = 'WAL' if wal else 'rollback journal'
+
+            with Fridge(path, wal=wal) as fridge:
+                # Only updates are made on this thread, so reads do not have to flush anything
+                fridge._flush_before_reads = False
+
+                start = time.perf_counter()
+                fridge.get_user_activity_summaries()
+                print(f'get_user_activity_summaries ({mode}, {rows} rows): {time.perf_counter() - start:.3f}s')
+
+                stop_reading = threading.Event()
+
+                def read_continuously():
+                    while not stop_reading.is_set():
+                        fridge.get_user_activity_summaries()
+
+                reader = threading.Thread(target=read_continuously)
+                reader.start()
+
+                latencies = []
+                timestamp = datetime.now()
+                for _ in range(updates):
+                    start = time.perf_counter()
+                    fridge.user_activity_update(random.randrange(users), UserStatus.Online, timestamp)
+                    latencies.append(time.perf_counter() - start)
+                    time.sleep(0.005)
+
+                stop_reading.set()
+                reader.join()
+
+                latencies.sort()
+                print(f'user_activity_update during summaries ({mode}): median {latencies[len(latencies) // 2]:.4f}s, '
+                      f'max {latencies[-1]:.4f}s')
+
+
+# The per-user reconciliation done by Fridge.user_activity_init before it was made set based
+def _legacy_user_activity_init(fridge, active_users):
+    current_timestamp = datetime.now()
+    last_connected_timestamp = fridge._connection.execute('SELECT timestamp FROM SalsaActivity').fetchone()
+    change_timestamp = last_connected_timestamp[0] + (current_timestamp - last_connected_timestamp[0]) / 2
+    for user_id, db_status in fridge._connection.execute(
+            'SELECT id, status FROM UserActivityView WHERE duration IS NULL').fetchall():
+        current_status = active_users.pop(user_id, UserStatus.Offline)
+        if db_status != current_status:
+            fridge.user_activity_update(user_id, current_status, change_timestamp)
+
+    for user_id, current_status in active_users.items():
+        fridge.user_activity_update(user_id, current_status, current_timestamp)
+
+
+# Startup reconciliation of the activity of a large guild after a short disconnect. Roughly half of the members changed
+# status, went offline, or came online while we were disconnected
+def bench_activity_init(members=10000):
+    statuses = [status for status in UserStatus if status != UserStatus.Offline]
+
+    for legacy in (True, False):
+        with tempfile.TemporaryDirectory() as directory:
+            # Write-behind batches the per-user updates of the legacy reconciliation, as it would in the bot
+            with Fridge(os.path.join(directory, 'bench.db'), write_behind=True) as fridge:
+                random.seed(0)
+                fridge.salsa_activity_update_connected()
+                fridge.user_activity_init({user_id: random.choice(statuses) for user_id in range(members)})
+
+                active_users = {user_id: random.choice(statuses) if random.random() < 0.2 else status
+                                for user_id, status in fridge._connection.execute(
+                                    'SELECT id, status FROM UserActivityView WHERE duration IS NULL')
+                                if random.random() > 0.1}
+                new_members = range(members, members * 11 // 10)
+                active_users.update((user_id, random.choice(statuses)) for user_id in new_members)
+
+                start = time.perf_counter()
+                if legacy:
+                    _legacy_user_activity_init(fridge, active_users)
+                else:
+                    fridge.user_activity_init(active_users)
+                fridge.flush()
+
+                _report(f'user_activity_init ({"per-user" if legacy else "set based"})', members,
+                        time.perf_counter() - start)
+
+
+async def _noop():
+    pass
+
+
+# Scheduling, rescheduling and cancelling many LongTermScheduler tasks, then dispatching the ones that are left
+def bench_scheduler(tasks=100000):
+    LongTermScheduler = _import_utilities().LongTermScheduler
+
+    random.seed(0)
+    now = datetime.now()
+    scheduler = LongTermScheduler()
+
+    start = time.perf_counter()
+    scheduled = [scheduler.schedule(_noop(), now + timedelta(seconds=random.randint(0, 3600))) for _ in range(tasks)]
+    _report('LongTermScheduler.schedule', tasks, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for task in scheduled:
+        task.reschedule(now - timedelta(seconds=random.randint(0, 3600)))
+    _report('LongTermTask.reschedule', tasks, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for task in scheduled[::2]:
+        task.cancel()
+    _report('LongTermTask.cancel', tasks // 2, time.perf_counter() - start)
+
+    async def dispatch():
+        run = asyncio.create_task(scheduler.run())
+        while scheduler._peek() is not None or scheduler._running_tasks:
+            await asyncio.sleep(0.01)
+        run.cancel()
+        await asyncio.gather(run, return_exceptions=True)
+
+    start = time.perf_counter()
+    asyncio.run(dispatch())
+    _report('LongTermScheduler dispatch', tasks - tasks // 2, time.perf_counter() - start)
+
+
+# The separate substring scans on_message made for its triggers before they were compiled into one matcher
+def _legacy_message_triggers(content, brian_emoji):
+    content_lower = content.lower()
+    content_basic = content_lower.replace(" ", "")
+    triggers = set()
+    if "🦐" in content or "shrimp" in content_lower:
+        triggers.add('shrimp')
+    if any((item in content_basic) for item in (brian_emoji, "brian", "brain")):
+        triggers.add('brian')
+    if "reddit.com" in content_lower:
+        triggers.add('reddit')
+    if "youtube.com" in content_lower or "youtu.be" in content_lower:
+        triggers.add('youtube')
+    if any((pattern in content_basic) for pattern in ('ty', 'thx', 'thank')):
+        triggers.add('thanks')
+    if 'salsa' in content_basic:
+        triggers.add('salsa')
+    return triggers
+
+
+# Create messages which look like chat, with the occasional link, emoji or trigger word
+def _create_message_corpus(count):
+    words = ['the', 'a', 'lol', 'what', 'is', 'this', 'game', 'tonight', 'i', 'think', 'you', 'should', 'play',
+             'brb', 'ok', 'yeah', 'no', 'maybe', 'later', 'going', 'to', 'eat', 'food', 'who', 'wants', 'vc',
+             'Shrimp', 'brain', 'Salsa', 'thanks', 'ty', '🦐', '😂', 'https://www.reddit.com/r/all',
+             'https://youtu.be/dQw4w9WgXcQ', 'https://www.youtube.com/watch?v=dQw4w9WgXcQ', 'Today', 'pretty']
+    weights = [100] * 26 + [1] * 11 + [100]
+
+    random.seed(0)
+    return [' '.join(random.choices(words, weights, k=random.randint(1, 40))) for _ in range(count)]
+
+
+# Finding the triggers in each message with separate substring scans, and with the single pass KeywordMatcher
+def bench_keyword_matcher(messages=200000):
+    # utilities depends on discord, so only import it when needed
+    import salsa_settings as ss
+    from utilities import KeywordMatcher
+
+    corpus = _create_message_corpus(messages)
+    brian_emoji = f'<:bobsbrian:{ss.BOBS_BRIAN_ID}>'
+
+    start = time.perf_counter()
+    legacy_triggers = [_legacy_message_triggers(content, brian_emoji) for content in corpus]
+    _report('message triggers (substring scans)', messages, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    matcher = KeywordMatcher(ss.MESSAGE_TRIGGER_KEYWORDS, ss.MESSAGE_TRIGGERS_IGNORING_SPACES)
+    triggers = [matcher.match(content.lower()) for content in corpus]
+    _report('message triggers (KeywordMatcher)', messages, time.perf_counter() - start)
+
+    mismatches = sum(legacy != new for legacy, new in zip(legacy_triggers, triggers))
+    print(f'message triggers: {mismatches} messages matched differently')
+
+
+# The quadratic split_respect_quotes used before the single pass tokenizer, without its cache
+def _legacy_split_respect_quotes(text):
+    quote_indexes = []
+    skipped_sections = []
+
+    # Start by finding the locations of all escaped characters, whitespace, and potential grouping quotes
+    start = 0
+    backslash = False
+    whitespace = False
+    for stop, character in enumerate(text):
+        if backslash:
+            if character in ('\\', '"', '\''):
+                skipped_sections.append((stop-1, stop, False))
+            backslash = False
+        elif character == '\\':
+            backslash = True
+        elif character in ('"', '\''):
+            quote_indexes.append(stop)
+
+        if whitespace ^ (character in (' ', '\t')):
+            if whitespace:
+                skipped_sections.append((start, stop, True))
+            else:
+                start = stop
+            whitespace = not whitespace
+
+    if whitespace:
+        skipped_sections.append((start, len(text), True))
+
+    # Figure out which grouping quotes are 'real' and which ones should be interpreted as literal quotes
+    grouping_quotes = []
+    quote = 0
+    while quote < len(quote_indexes):
+        found = False
+        for search in range(quote+1, len(quote_indexes)):
+            if text[quote_indexes[quote]] == text[quote_indexes[search]]:
+                grouping_quotes.append((quote_indexes[quote], quote_indexes[search]))
+                quote = search + 1
+                found = True
+                break
+
+        if not found:
+            quote += 1
+
+    # Insert the grouping quotes into the skipped_sections, as we do not want grouping quotes included in output
+    index = 0
+    for quote in (quote for quote_pair in grouping_quotes for quote in quote_pair):
+        while index < len(skipped_sections) and skipped_sections[index][0] < quote:
+            index += 1
+
+        skipped_sections.insert(index, (quote, quote+1, False))
+
+    # Checks if we are inside grouping quotes and the skip should not be applied if it is whitespace
+    def inside_grouping_quotes(_skip_start):
+        while grouping_quotes:
+            quote_start, quote_stop = grouping_quotes[0]
+            if quote_stop < _skip_start:
+                del grouping_quotes[0]
+            else:
+                return quote_start < _skip_start < quote_stop
+
+    result = []
+    parts = []
+    start = 0
+
+    # Chop up the original string using slicing and piece together the parts we need to form the result strings
+    for skip_start, skip_stop, whitespace in skipped_sections:
+        if whitespace and inside_grouping_quotes(skip_start):
+            continue
+
+        parts.append(text[start:skip_start])
+
+        if whitespace:
+            result.append(''.join(parts))
+            parts = []
+
+        start = skip_stop
+
+    parts.append(text[start:])
+    result.append(''.join(parts))
+
+    # Filter out empty strings from the results and return finally
+    return [split_text for split_text in result if split_text]
+
+
+# Create text made of words, whitespace, quotes and backslashes, in the proportions given by weights
+def _create_quoted_text(length, weights=(60, 15, 10, 10, 5)):
+    pieces = (['word', 'a', 'Big Bob', 'x,y'], [' ', '  ', '\t'], ['"'], ['\''], ['\\'])
+    return ''.join(random.choice(random.choices(pieces, weights)[0]) for _ in range(length))
+
+
+# Check that split_respect_quotes gives the same results as before on random inputs, and time it on long inputs with
+# lots of quotes
+def bench_split_respect_quotes(checks=20000, length=50000, runs=5):
+    split_respect_quotes = _import_utilities().split_respect_quotes
+
+    random.seed(0)
+    mismatches = 0
+    for _ in range(checks):
+        text = _create_quoted_text(random.randint(0, 30), [random.randint(0, 10) for _ in range(5)])
+        if split_respect_quotes(text) != _legacy_split_respect_quotes(text):
+            mismatches += 1
+            print(f'split_respect_quotes differs for {text!r}')
+    print(f'split_respect_quotes: {mismatches} of {checks} random texts split differently')
+
+    for name, weights in (('few quotes', (80, 15, 2, 2, 1)), ('quote heavy', (20, 10, 30, 30, 10))):
+        texts = [_create_quoted_text(length, weights) for _ in range(runs)]
+
+        start = time.perf_counter()
+        for text in texts:
+            _legacy_split_respect_quotes(text)
+        _report(f'split_respect_quotes ({name}, {length} pieces, before)', runs, time.perf_counter() - start)
+
+        split_respect_quotes.cache_clear()
+        start = time.perf_counter()
+        for text in texts:
+            split_respect_quotes(text)
+        _report(f'split_respect_quotes ({name}, {length} pieces)', runs, time.perf_counter() - start)
+
+
+# Verify that the hot Fridge queries are all answered using indexes
+def check_query_plans():
+    with tempfile.TemporaryDirectory() as directory:
+        with Fridge(os.path.join(directory, 'bench.db')) as fridge:
+            bad_plans = fridge.check_query_plans()
+
+    for sql, plan in bad_plans.items():
+        print(f'Query does not use an index: {sql}\n    {plan}')
+    print(f'query plans: {len(bad_plans)} queries without an index')
+
+
+BENCHMARKS = {
+    'activity_init': bench_activity_init,
+    'alias_map': bench_alias_map,
+    'keyword_matcher': bench_keyword_matcher,
+    'query_plans': check_query_plans,
+    'scheduler': bench_scheduler,
+    'split_respect_quotes': bench_split_respect_quotes,
+    'wal': bench_wal,
+}
+
+
+if __name__ == '__main__':
+    for benchmark_name in sys.argv[1:] or BENCHMARKS.keys():
+        BENCHMARKS[benchmark_name]()
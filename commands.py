@@ -14,6 +14,7 @@ from functools import partial
 
 import utilities
 from fridge import UserStatus, VoiceStatus
+from outbound import Priority
 from main import SalsaClient
 
 # Stores the last command issued by each user
@@ -48,6 +49,65 @@ def _error(message: str):
     return embed
 
 
+# Normalize command text for looking up commands, by removing everything the command matching ignores
+def normalize_command_text(text: str) -> str:
+    return ''.join(text.split()).lower().translate(_NORMALIZE_COMMAND_TEXT_TABLE)
+
+
+_NORMALIZE_COMMAND_TEXT_TABLE = str.maketrans('', '', '"\'\\')
+
+
+class ConversionError(ValueError):
+    pass
+
+
+# TODO Add an insult instead of sorry when conversion fails
+def _convert_to_str(bot: SalsaClient, arg: str, index: int) -> str:
+    # Hahaha, that was easy!
+    return arg
+
+
+def _convert_to_int(bot: SalsaClient, arg: str, index: int) -> int:
+    try:
+        return int(arg)
+    except ValueError:
+        raise ConversionError(f'I was expecting a number, but you gave me `{arg}` at position {index}. '
+                              f'Sorry, please try again :smiling_face_with_tear:')
+
+
+def _convert_to_member(bot: SalsaClient, arg: str, index: int) -> discord.Member:
+    member = get_member_by_username(bot, arg)
+    if member is None:
+        raise ConversionError(f"I can't find a Discord member with nickname, username, or ID matching "
+                              f'`{arg}`, as you gave me at position {index}. '
+                              f'Sorry, please try again :smiling_face_with_tear:')
+
+    return member
+
+
+def _convert_to_voice_channel(bot: SalsaClient, arg: str, index: int) -> discord.VoiceChannel:
+    channel = _get_voice_channel_helper(bot, arg)
+    if channel is None:
+        raise ConversionError(f"I can't find a voice channel with ID, link, or name matching "
+                              f'`{arg}`, as you gave me at position {index}. '
+                              f'Sorry, please try again :smiling_face_with_tear:')
+
+    return channel
+
+
+def _convert_to_unsupported_type(arg_type: Type, bot: SalsaClient, arg: str, index: int):
+    raise ConversionError(f'The bozo who developed this bot did not implement this command correctly! '
+                          f'Please yell at them! Info: index=`{index}`, arg=`{arg}`, arg_type=`{arg_type}`')
+
+
+_CONVERTERS = {str: _convert_to_str, int: _convert_to_int, discord.Member: _convert_to_member,
+               discord.VoiceChannel: _convert_to_voice_channel}
+
+
+def _get_converter(arg_type: Type) -> Callable[[SalsaClient, str, int], Any]:
+    return _CONVERTERS.get(arg_type, partial(_convert_to_unsupported_type, arg_type))
+
+
 class CommandContext:
     def __init__(self, bot: SalsaClient, context: Union[discord.Message, discord.Interaction]):
         self.context = context
@@ -56,7 +116,7 @@ class CommandContext:
 
         # Setup send() function to use the correct underlying f() call
         if self.is_message():
-            self._send = self.context.channel.send
+            self._send = partial(bot.outbound.send, self.context.channel, priority=Priority.Reply)
             self.author = self.context.author
         else:
             self._send = self.context.response.send_message
@@ -66,18 +126,18 @@ class CommandContext:
         if self.is_context_menu():
             await self.context.response.send_message(f'Redirecting to command channel!', ephemeral=True, delete_after=3)
             command_channel = get_command_channel(self.bot)
-            self._send = command_channel.send
+            self._send = partial(self.bot.outbound.send, command_channel, priority=Priority.Reply)
             text_args = args_to_text(args + tuple(kwargs.values()))
             if text_args:
                 text_args = ' ' + text_args
-            await command_channel.send(f'{self.author.display_name} executed `/{command_name}{text_args}`')
+            await self._send(f'{self.author.display_name} executed `/{command_name}{text_args}`')
 
     async def finish(self):
         if not self._responded:
             if self.is_slash_command():
                 await self.send('Done!')
             elif self.is_message():
-                await self.context.add_reaction('👍')
+                self.bot.outbound.react(self.context, '👍', priority=Priority.Reply)
 
     async def send(self, *args, **kwargs):
         self._responded = True
@@ -153,20 +213,33 @@ async def _have_salsa_instead(context: CommandContext):
     return True
 
 
+# The prefix is what the command text must start with, once normalized, for the match function to have any chance of
+# matching. It is the name for commands using the default match, and defaults to '' (always try to match) otherwise
 class SalsaCommand:
     def __init__(self, name: str, description: str,
                  invoke_func: Callable[[CommandContext, ...], Awaitable[None]],
-                 match_func: Callable[[str], Awaitable[Optional[List[str]]]] = None, *, display_name: str = None):
+                 match_func: Callable[[str], Awaitable[Optional[List[str]]]] = None, *, display_name: str = None,
+                 prefix: str = None):
         self.name = name
         self.description = description
         self._invoke = invoke_func
         self.match = partial(_default_match, name) if match_func is None else match_func
         self.display_name = name if display_name is None else display_name
+        self.prefix = normalize_command_text(prefix if prefix is not None else name if match_func is None else '')
+
+        # Signatures do not change, so look up the parameters and how to convert to their types once
+        self._parameters = [] if invoke_func is None else \
+            [parameter for i, parameter in enumerate(inspect.signature(invoke_func).parameters.values()) if i != 0]
+        self._converters = [_get_converter(parameter.annotation) for parameter in self.get_parameters()]
 
     # Returns the parameters to the command. When calling self.invoke(), the inputs should be
     # 1. A CommandContext object and 2. a list of parameters corresponding to the ones returned by this method
     def get_parameters(self) -> List[inspect.Parameter]:
-        return [parameter for i, parameter in enumerate(inspect.signature(self._invoke).parameters.values()) if i != 0]
+        return self._parameters
+
+    # Convert the str args of the command to the types of its parameters
+    def convert_args(self, bot: SalsaClient, args: List[str]) -> List[Any]:
+        return [converter(bot, arg, index) for index, (arg, converter) in enumerate(zip(args, self._converters), 1)]
 
     def get_docs(self) -> str:
         return self._invoke.__doc__
@@ -240,7 +313,7 @@ def _seen():
             return text + (':mobile_phone:' if is_mobile else '')
 
         current_timestamp = datetime.datetime.now()
-        last_activity = context.bot.fridge.get_last_user_activity(member.id)
+        last_activity = await context.bot.fridge.get_last_user_activity(member.id)
         if last_activity is None:
             description = f'There is no activity history for {member.name}. This could be my fault, or, it may have ' \
                           f'been a very long time since their last activity'
@@ -268,7 +341,7 @@ def _seen():
 
         embed.add_field(name='Last Known Status', value=last_known_status, inline=False)
 
-        last_vc_activity = context.bot.fridge.get_last_voice_activity(member.id)
+        last_vc_activity = await context.bot.fridge.get_last_voice_activity(member.id)
         if last_vc_activity is None:
             value = f'There is no VC history for {member.name}. This could be my fault, or, it may have been a very ' \
                     f'long time since their last VC'
@@ -420,7 +493,7 @@ def _nick_set():
         return [match.group(1), match.group(2)]
 
     return SalsaCommand(name='set', description='Nickname a server member',
-                        invoke_func=invoke, match_func=match)
+                        invoke_func=invoke, match_func=match, prefix='nickset')
 
 
 def _nick_clear():
@@ -448,7 +521,7 @@ def _nick_clear():
         return await _default_match('nickclear', command_text)
 
     return SalsaCommand(name='clear', description='Clear the nickname for a server member',
-                        display_name='nick clear', invoke_func=invoke, match_func=match)
+                        display_name='nick clear', invoke_func=invoke, match_func=match, prefix='nickclear')
 
 
 def _flip_a_coin():
@@ -482,7 +555,7 @@ def _pick_a_number():
         return [match.group(1), match.group(2)]
 
     return SalsaCommand(name='pickanumber', description='Pick a number from a range',
-                        invoke_func=invoke, match_func=match)
+                        invoke_func=invoke, match_func=match, prefix='pickanumber')
 
 
 CHOOSE_FROM_PATTERN = re.compile(r"(?i)choose\s*(\d*)\s*from\s*(.+)")
@@ -537,7 +610,7 @@ def _choose_from():
         return [options_list_text] + ([count_text] if count_text else [])
 
     return SalsaCommand(name='choosefrom', description='Choose one or more options from a list',
-                        invoke_func=invoke, match_func=match)
+                        invoke_func=invoke, match_func=match, prefix='choose')
 
 
 def _tea_me():
@@ -582,7 +655,7 @@ def _thanks():
         await context.send(ss.get_thank_you_reply(context.author))
 
         if context.is_message():
-            await context.context.add_reaction("👍")
+            context.bot.outbound.react(context.context, "👍", priority=Priority.Reply)
 
     async def match(command_text: str) -> Optional[List[str]]:
         command_text_no_whitespace = command_text.replace(" ", "")
@@ -633,12 +706,74 @@ def _sync():
     return SalsaCommand(name='sync', description='Sync the bot commands to Discord', invoke_func=invoke)
 
 
+def _scheduler():
+    async def invoke(context: CommandContext) -> None:
+        if not await context.bot.is_owner(context.author):
+            await context.send(embed=_error('Only the bot owner is allowed to run this command!'))
+            return
+
+        def median(samples):
+            return sorted(samples)[len(samples) // 2] if samples else 0
+
+        scheduler = context.bot.long_term_scheduler
+        lines = [f'Scheduled: {scheduler.scheduled_count()}, Running: {scheduler.running_count()}',
+                 f'{"Job":<32} {"Runs":>5} {"Fails":>5} {"Late (med/max)":>15} {"Time (med/max)":>15}  Next due']
+
+        now = datetime.datetime.now()
+        for name, metrics in sorted(scheduler.job_metrics().items(), key=lambda item: item[1].next_due or now):
+            next_due = '-' if metrics.next_due is None else f'{metrics.next_due:%Y-%m-%d %H:%M:%S}'
+            lateness = f'{median(metrics.lateness):.1f}/{max(metrics.lateness, default=0):.1f}s'
+            run_time = f'{median(metrics.run_times):.1f}/{max(metrics.run_times, default=0):.1f}s'
+            lines.append(f'{name[-32:]:<32} {metrics.runs:>5} {metrics.failures:>5} {lateness:>15} {run_time:>15}  '
+                         f'{next_due}')
+
+        # Stay below the Discord message length limit
+        text = '\n'.join(lines)
+        if len(text) > 1900:
+            text = text[:1900] + '\n...'
+
+        await context.send(f'```{text}```')
+
+    return SalsaCommand(name='scheduler', description='Show the long term scheduler metrics', invoke_func=invoke)
+
+
 # Constants containing the command objects in the correct processing order
 JUGGLE_COMMAND = _juggle()
 SLASH_COMMANDS = (RedoCommand(), _choose_from(), _tea_me(), _flip_a_coin(), _magic_8_ball(), 
                   _pick_a_number(), _move_all(), JUGGLE_COMMAND, _seen(), _thanks(), _help())
 NICK_COMMANDS = (_nick_set(), _nick_clear())
-TEXT_COMMANDS = (_sync(),) + SLASH_COMMANDS + NICK_COMMANDS
+TEXT_COMMANDS = (_sync(), _scheduler()) + SLASH_COMMANDS + NICK_COMMANDS
+
+
+# Finds the commands which could match some command text, from the command prefixes. Looking them up is a single walk
+# down a trie of the prefixes, no matter how many commands there are
+class CommandIndex:
+    def __init__(self, commands: Iterable[SalsaCommand]):
+        # Each node is a dict of the next characters to their nodes, plus None to the (order, command) pairs of the
+        # commands with that prefix
+        self._root = {}
+        for order, command in enumerate(commands):
+            node = self._root
+            for character in command.prefix:
+                node = node.setdefault(character, {})
+            node.setdefault(None, []).append((order, command))
+
+    # Get the commands which could match the command text, in the order they were given
+    def candidates(self, command_text: str) -> List[SalsaCommand]:
+        node = self._root
+        found = list(node.get(None, ()))
+        for character in normalize_command_text(command_text):
+            node = node.get(character)
+            if node is None:
+                break
+
+            found.extend(node.get(None, ()))
+
+        found.sort(key=lambda order_command: order_command[0])
+        return [command for _, command in found]
+
+
+TEXT_COMMAND_INDEX = CommandIndex(TEXT_COMMANDS)
 
 
 def load_app_commands(bot: SalsaClient):
@@ -717,45 +852,6 @@ def _get_voice_channel_helper(bot: 'SalsaClient', name_or_id: str) -> Optional[d
     return None
 
 
-class ConversionError(ValueError):
-    pass
-
-
-# TODO Add an insult instead of sorry when conversion fails
-def convert_args(bot: SalsaClient, args: List[str], types: List[Type]) -> List[Any]:
-    converted_args = []
-    for index, (arg, arg_type) in enumerate(zip(args, types), 1):
-        if arg_type == str:
-            # Hahaha, that was easy!
-            converted_args.append(arg)
-        elif arg_type == int:
-            try:
-                converted_args.append(int(arg))
-            except ValueError:
-                raise ConversionError(f'I was expecting a number, but you gave me `{arg}` at position {index}. '
-                                      f'Sorry, please try again :smiling_face_with_tear:')
-        elif arg_type == discord.Member:
-            member = get_member_by_username(bot, arg)
-            if member is None:
-                raise ConversionError(f"I can't find a Discord member with nickname, username, or ID matching "
-                                      f'`{arg}`, as you gave me at position {index}. '
-                                      f'Sorry, please try again :smiling_face_with_tear:')
-
-            converted_args.append(member)
-        elif arg_type == discord.VoiceChannel:
-            channel = _get_voice_channel_helper(bot, arg)
-            if channel is None:
-                raise ConversionError(f"I can't find a voice channel with ID, link, or name matching "
-                                      f'`{arg}`, as you gave me at position {index}. '
-                                      f'Sorry, please try again :smiling_face_with_tear:')
-            converted_args.append(channel)
-        else:
-            raise ConversionError(f'The bozo who developed this bot did not implement this command correctly! '
-                                  f'Please yell at them! Info: index=`{index}`, arg=`{arg}`, arg_type=`{arg_type}`')
-
-    return converted_args
-
-
 async def handle(bot: SalsaClient, message: discord.Message):
     # See if the message starts with !salsa
     match = BOT_COMMAND_PATTERN.fullmatch(message.content)
@@ -764,16 +860,15 @@ async def handle(bot: SalsaClient, message: discord.Message):
 
     # Attempt to match the command text and then invoke the correct command
     command_text = match.group(1)
-    for command in TEXT_COMMANDS:
+    for command in TEXT_COMMAND_INDEX.candidates(command_text):
         args = await command.match(command_text)
         if args is not None:
-            types = [parameter.annotation for parameter in command.get_parameters()]
             context = CommandContext(bot, message)
 
             # Attempt to convert the str args of the command to the appropriate types and then invoke the command.
             # If there is a conversion error we will print the message to the user and then gracefully exit
             try:
-                converted_args = convert_args(bot, args, types)
+                converted_args = command.convert_args(bot, args)
                 await context.prepare(command.name, *converted_args)
                 await command.invoke(context, *converted_args)
             except ConversionError as error:
@@ -787,5 +882,6 @@ async def handle(bot: SalsaClient, message: discord.Message):
             return True
 
     # Unknown command
-    await message.channel.send(f'Unknown command: `{command_text}`. Try `!salsa` for help!')
+    await bot.outbound.send(message.channel, f'Unknown command: `{command_text}`. Try `!salsa` for help!',
+                            priority=Priority.Reply)
     return True
@@ -1,8 +1,15 @@
+import asyncio
+import json
 import sqlite3
+import traceback
 from enum import IntEnum
+from functools import partial
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from datetime import time
 from datetime import timedelta
-from typing import Type, Union, Dict, Tuple, Optional
+from typing import Type, Union, Dict, Tuple, Optional, List
 
 
 class SalsaStatus(IntEnum):
@@ -71,7 +78,8 @@ class UserActivitySummary:
     def __init__(self, start: datetime, stop: datetime):
         self.start = start
         self.stop = stop
-        self.sum: Dict[UserStatus, timedelta] = {}
+        self.sum: Dict[UserStatus, timedelta] = {status: timedelta() for status in UserStatus
+                                                 if status != UserStatus.Offline}
 
     def get_sum_avg_and_pc_percentage(self, status: UserStatus, period: timedelta = timedelta(days=1)) \
             -> Tuple[timedelta, timedelta, float]:
@@ -79,16 +87,189 @@ class UserActivitySummary:
         mobile_sum = self.sum[user_status_adjust_mobile(status, True)]
         combined_sum = pc_sum + mobile_sum
         number_of_periods = (self.stop - self.start) / period
+        if number_of_periods <= 0:
+            # Nothing can have been recorded in an empty window
+            return timedelta(), timedelta(), 0.0
 
-        return combined_sum, combined_sum / number_of_periods, pc_sum / combined_sum
+        pc_percentage = pc_sum / combined_sum if combined_sum else 0.0
+
+        return combined_sum, combined_sum / number_of_periods, pc_percentage
 
 
 ACCEPTABLE_DOWNTIME = timedelta(minutes=10)
 
 
+# Tuning applied to both the write and read connections. The Pi has plenty of memory for a larger page cache and memory
+# mapped reads, and temporary tables/indexes for sorting and grouping are kept off the SD card
+CONNECTION_PRAGMAS = ['PRAGMA cache_size=-16384', 'PRAGMA mmap_size=268435456', 'PRAGMA temp_store=MEMORY']
+
+# Each entry is the list of statements that migrates the db schema from version N to N+1. The current schema version
+# is stored in PRAGMA user_version. Never edit a migration that has been released, add a new one instead
+SCHEMA_MIGRATIONS = [
+    # 1: Tables and views. Databases created before versioning are at version 0 and already contain these
+    [
+        'CREATE TABLE IF NOT EXISTS SalsaActivity (status SalsaStatus, timestamp Timestamp)',
+
+        'CREATE TABLE IF NOT EXISTS UserIDs (id Integer NOT NULL UNIQUE)',
+
+        'CREATE TABLE IF NOT EXISTS UserActivity '
+        '(id Integer, status UserStatus, start Timestamp, duration Duration)',
+
+        'CREATE TABLE IF NOT EXISTS VoiceActivity '
+        '(id Integer, status VoiceStatus, start Timestamp, duration Duration)',
+
+        'CREATE VIEW IF NOT EXISTS UserActivityView AS '
+        'SELECT UserIDs.id, UserActivity.status, UserActivity.start, UserActivity.duration '
+        'FROM UserActivity LEFT JOIN UserIDs ON UserActivity.id=UserIDs.rowid',
+
+        'CREATE VIEW IF NOT EXISTS VoiceActivityView AS '
+        'SELECT UserIDs.id, VoiceActivity.status, VoiceActivity.start, VoiceActivity.duration '
+        'FROM VoiceActivity LEFT JOIN UserIDs ON VoiceActivity.id=UserIDs.rowid'
+    ],
+
+    # 2: Indexes for looking up the latest entries of a user and for finding open entries (duration IS NULL)
+    [
+        'CREATE INDEX SalsaActivityByStatus ON SalsaActivity (status, timestamp)',
+        'CREATE INDEX UserActivityByUser ON UserActivity (id, start)',
+        'CREATE INDEX UserActivityOpen ON UserActivity (id) WHERE duration IS NULL',
+        'CREATE INDEX VoiceActivityByUser ON VoiceActivity (id, start)',
+        'CREATE INDEX VoiceActivityOpen ON VoiceActivity (id) WHERE duration IS NULL'
+    ],
+
+    # 3: Hourly and daily rollups of the time each user spent in each status, and start indexes for clipping the raw
+    # entries at the edges of a time window. The rollups are filled by Fridge.rebuild_rollups() after this migration
+    [
+        f'CREATE TABLE {table}{period} (id Integer, status {status_type}, start Timestamp, seconds Integer, '
+        f'PRIMARY KEY (id, status, start)) WITHOUT ROWID'
+        for table, status_type in (('UserActivity', 'UserStatus'), ('VoiceActivity', 'VoiceStatus'))
+        for period in ('Hourly', 'Daily')
+    ] + [
+        'CREATE INDEX UserActivityHourlyByStart ON UserActivityHourly (start)',
+        'CREATE INDEX UserActivityDailyByStart ON UserActivityDaily (start)',
+        'CREATE INDEX VoiceActivityHourlyByStart ON VoiceActivityHourly (start)',
+        'CREATE INDEX VoiceActivityDailyByStart ON VoiceActivityDaily (start)',
+        'CREATE INDEX UserActivityByStart ON UserActivity (start)',
+        'CREATE INDEX VoiceActivityByStart ON VoiceActivity (start)'
+    ],
+
+    # 4: Index of the monthly archive tables that old activity entries are moved into by Fridge.archive_activity().
+    # start is the earliest start, stop is the latest end, and longest is the longest duration of an archived entry
+    [
+        'CREATE TABLE ActivityArchives (name Text PRIMARY KEY, activity Text, start Timestamp, stop Timestamp, '
+        'longest Duration)'
+    ],
+
+    # 5: Scheduler jobs which survive restarts (see utilities.PersistentJobs). arguments is a JSON list
+    [
+        'CREATE TABLE ScheduledJobs (name Text PRIMARY KEY, kind Text NOT NULL, arguments Text NOT NULL, '
+        'next_run Timestamp NOT NULL)'
+    ]
+]
+
+# The schema version which introduced the rollup tables
+ROLLUP_SCHEMA_VERSION = 3
+
+# Activity tables and the type of their status column
+ACTIVITY_TABLES = [('UserActivity', 'UserStatus'), ('VoiceActivity', 'VoiceStatus')]
+
+# Older sqlite versions allow at most 999 parameters in a single query
+MAX_QUERY_PARAMETERS = 999
+
+# The queries run on every activity update, /seen, and startup, along with example parameters. These must never need
+# to scan a whole table, which is verified by Fridge.check_query_plans()
+HOT_QUERIES = [
+    ('UPDATE SalsaActivity SET timestamp=? WHERE status=?', (0, SalsaStatus.Connected)),
+    ('SELECT timestamp FROM SalsaActivity WHERE status=? ORDER BY timestamp DESC LIMIT 1', (SalsaStatus.Connected,)),
+] + [query for table in ('UserActivity', 'VoiceActivity') for query in (
+    (f'UPDATE {table} SET duration=MAX(?-start,0) WHERE duration IS NULL AND id=?', (0, 0)),
+    (f'UPDATE {table} SET duration=MAX(?-start,0) WHERE duration IS NULL', (0,)),
+    (f'SELECT id, status, start+0 FROM {table} WHERE duration IS NULL', ()),
+    (f'SELECT id, status, start+0 FROM {table} WHERE duration IS NULL AND id IN (?,?)', (0, 0)),
+)]
+
+
+# Split the period between two Unix timestamps into (hour, seconds) pieces, where hour is the timestamp at the start of
+# each hour that the period overlaps. Hours are aligned to UTC, which matches local hours in whole hour time zones
+def _split_by_hour(start: int, stop: int):
+    hour = start - start % 3600
+    while hour < stop and start < stop:
+        next_hour = hour + 3600
+        yield hour, min(stop, next_hour) - max(start, hour)
+        hour = next_hour
+
+
+# Get the Unix timestamp of the local midnight at the start of the day containing the given Unix timestamp
+def _local_midnight(timestamp: int) -> int:
+    return round(datetime.combine(datetime.fromtimestamp(timestamp).date(), time()).timestamp())
+
+
+# Get the Unix timestamp of the first local midnight at or after the given Unix timestamp
+def _next_local_midnight(timestamp: int) -> int:
+    midnight = _local_midnight(timestamp)
+    if midnight == timestamp:
+        return midnight
+
+    return round(datetime.combine(datetime.fromtimestamp(timestamp).date() + timedelta(days=1), time()).timestamp())
+
+
+# SQL for the (id, status, seconds) time spent by users in each status within [start, stop), using the raw UserActivity
+# entries. Entries are clipped to the window and open entries count up until :now. The only entry that can start
+# before the window and still overlap it is the latest one each user started before the window. If for_user is True,
+# only the entries of the user with discord ID :user_id are included
+def _raw_activity_sql(start: int, stop: int, for_user: bool, open_only: bool = False) -> str:
+    user_filter = ' AND id=(SELECT rowid FROM UserIDs WHERE id=:user_id)' if for_user else ''
+    if open_only:
+        return f'SELECT id, status, MIN(:now,{stop})-MAX(start,{start}) AS seconds FROM UserActivity ' \
+               f'WHERE duration IS NULL AND start<{stop} AND :now>{start}{user_filter}'
+
+    return f'SELECT id, status, MIN(start+IFNULL(duration,:now-start),{stop})-MAX(start,{start}) AS seconds ' \
+           f'FROM UserActivity WHERE start+IFNULL(duration,:now-start)>{start} AND rowid IN (' \
+           f'SELECT rowid FROM UserActivity WHERE start>={start} AND start<{stop}{user_filter} UNION ALL ' \
+           f'SELECT (SELECT rowid FROM UserActivity WHERE id=UserIDs.rowid AND start<{start} ' \
+           f'ORDER BY start DESC LIMIT 1) FROM UserIDs' + (' WHERE id=:user_id)' if for_user else ')')
+
+
+# Same as _raw_activity_sql(), but for the given archive table. Archived entries are never open, and entries which
+# overlap the window start no earlier than the longest archived duration before the window
+def _archived_activity_sql(archive: str, start: int, stop: int, longest: int, for_user: bool) -> str:
+    user_filter = ' AND id=(SELECT rowid FROM UserIDs WHERE id=:user_id)' if for_user else ''
+    return f'SELECT id, status, MIN(start+duration,{stop})-MAX(start,{start}) AS seconds FROM {archive} ' \
+           f'WHERE start>={start - longest} AND start<{stop} AND start+duration>{start}{user_filter}'
+
+
+# SQL for the (id, status, seconds) time spent by users in each status within [start, stop), using the rollups for the
+# given period. start and stop must be aligned to the period
+def _rollup_activity_sql(period: str, start: int, stop: int, for_user: bool) -> str:
+    user_filter = ' AND id=(SELECT rowid FROM UserIDs WHERE id=:user_id)' if for_user else ''
+    return f'SELECT id, status, seconds FROM UserActivity{period} WHERE start>={start} AND start<{stop}{user_filter}'
+
+
 class Fridge:
-    def __init__(self, db_file):
+    # When write_behind is enabled, activity updates are queued in memory and written to the db in batches by flush().
+    # The queue is also flushed automatically once it holds max_pending_updates entries. When wal is enabled the db is
+    # opened in WAL mode, so that queries on the read connection never block writes and vice versa
+    def __init__(self, db_file, write_behind: bool = False, max_pending_updates: int = 200, wal: bool = True):
         self._db_file = db_file
+        self._write_behind = write_behind
+        self._max_pending_updates = max_pending_updates
+        self._wal = wal
+
+        # Queries which only read the db are run on a separate read-only connection. Before each query, any queued
+        # updates are flushed so that they are visible to it. AsyncFridge turns this off and flushes by itself, as it
+        # runs queries on a different thread than the writes
+        self._flush_before_reads = True
+
+        # Queued (user_id, status, timestamp) activity updates that have not been written to the db yet
+        self._pending_user_updates: List[Tuple[int, UserStatus, datetime]] = []
+        self._pending_voice_updates: List[Tuple[int, VoiceStatus, datetime]] = []
+
+        # Write-through cache of the UserIDs table, mapping discord user_id -> alias ID. Loaded in __enter__
+        self._alias_ids: Dict[int, int] = {}
+
+        # The latest (status, start, duration) entry of every user in each activity table, mapping discord user_id ->
+        # entry. Loaded in __enter__ and kept up to date by the updates, including the ones that are still queued
+        self._last_activity: Dict[str, Dict[int, Tuple[IntEnum, datetime, Optional[timedelta]]]] = {
+            table: {} for table, _ in ACTIVITY_TABLES}
 
     def salsa_activity_update_connected(self):
         with self._connection:
@@ -105,153 +286,469 @@ class Fridge:
     # Initialize logging of user activity (e.g. discord status - Online, Idle, Do Not Disturb)
     # active_users must be an up-to-date list of the {user_id,status} of non-offline users
     def user_activity_init(self, active_users: Dict[int, UserStatus]):
-        current_timestamp = datetime.now()
-        last_connected_timestamp = self._connection.execute(
-            'SELECT timestamp FROM SalsaActivity WHERE status=? ORDER BY timestamp DESC LIMIT 1',
-            (SalsaStatus.Connected,)).fetchone()
-
-        if last_connected_timestamp is None:
-            # If there is no connected timestamp, this must be a new db and the UserActivity table must also be empty
-            table_has_content = self._connection.execute('SELECT EXISTS(SELECT 1 FROM UserActivity)').fetchone()[0]
-            if table_has_content:
-                raise Exception('Database corruption!')
-        elif current_timestamp - last_connected_timestamp[0] > ACCEPTABLE_DOWNTIME:
-            # If we have been disconnected for longer than the acceptable downtime, we must finish old activity entries
-            # in the db and assume that those users went offline when we were disconnected
-            with self._connection:
-                self._connection.execute(
-                    'UPDATE UserActivity SET duration=MAX(?-start,0) WHERE duration IS NULL',
-                    (last_connected_timestamp[0],))
-        else:
-            # If we have been disconnected for less than the acceptable downtime, then we may assume that any users who
-            # were previously online and are STILL online have been online during our period of downtime
-            change_timestamp = last_connected_timestamp[0] + (current_timestamp - last_connected_timestamp[0]) / 2
-            for user_id, db_status in self._connection.execute(
-                    'SELECT id, status FROM UserActivityView WHERE duration IS NULL'):
-                current_status = active_users.pop(user_id, UserStatus.Offline)
-                if db_status != current_status:
-                    self.user_activity_update(user_id, current_status, change_timestamp)
-
-        # For any users who are currently online and not present in the database, open entries for them
-        for user_id, current_status in active_users.items():
-            self.user_activity_update(user_id, current_status, current_timestamp)
+        self._activity_init('UserActivity', active_users, UserStatus.Offline)
 
     def user_activity_update(self, user_id: int, status: UserStatus, timestamp=None):
         if timestamp is None:
             timestamp = datetime.now()
 
-        # Close any open entry for this user and then open a new entry with the updated status
-        alias_id = self.get_alias_id(user_id)
-        with self._connection:
-            self._connection.execute(
-                'UPDATE UserActivity SET duration=MAX(?-start,0) WHERE '
-                'duration IS NULL AND id=?', (timestamp, alias_id))
-
-            if status != UserStatus.Offline:
-                self._connection.execute('INSERT INTO UserActivity VALUES(?,?,?,NULL)', (alias_id, status, timestamp))
+        self._remember_activity('UserActivity', user_id, status, timestamp, UserStatus.Offline)
+        if self._write_behind:
+            self._pending_user_updates.append((user_id, status, timestamp))
+            self._flush_if_full()
+        else:
+            changes = self._prepare_activity_updates([(user_id, status, timestamp)], UserStatus.Offline)
+            with self._connection:
+                self._write_activity_updates('UserActivity', *changes)
 
     def get_last_user_activity(self, user_id: int) -> Optional[Tuple[UserStatus, datetime, timedelta]]:
-        activity_info = self._connection.execute('SELECT status, start, duration FROM UserActivityView '
-                                                 'WHERE id=? ORDER BY start DESC LIMIT 1', (user_id,)).fetchone()
-        return activity_info
-
-    def get_user_activity_summary(self, user_id: int, start: datetime = datetime.min, stop: datetime = datetime.max):
-        pass
+        return self._last_activity['UserActivity'].get(user_id)
+
+    # Sum up the time that a user spent in each status during [start, stop). Entries which cross the edges of the window
+    # are clipped, and open entries count up until the current time. The window is limited to the recorded history
+    def get_user_activity_summary(self, user_id: int, start: datetime = datetime.min,
+                                  stop: datetime = datetime.max) -> UserActivitySummary:
+        summaries = self._get_user_activity_summaries(start, stop, user_id)
+        return summaries.get(user_id, UserActivitySummary(*self._clamp_summary_window(start, stop)))
+
+    # Same as get_user_activity_summary(), but for every user with activity in the window, in a single query
+    def get_user_activity_summaries(self, start: datetime = datetime.min,
+                                    stop: datetime = datetime.max) -> Dict[int, UserActivitySummary]:
+        return self._get_user_activity_summaries(start, stop)
+
+    def _get_user_activity_summaries(self, start: datetime, stop: datetime, user_id: Optional[int] = None):
+        self._before_read()
+
+        start, stop = self._clamp_summary_window(start, stop)
+        start_timestamp, stop_timestamp = round(start.timestamp()), round(stop.timestamp())
+        if start_timestamp >= stop_timestamp:
+            return {}
+
+        # The whole hours and days in the middle of the window are read from the rollups, which only contain finished
+        # entries. Raw entries are only needed for the partial hours at each edge and for open entries
+        first_hour = -(-start_timestamp // 3600) * 3600
+        last_hour = stop_timestamp - stop_timestamp % 3600
+        for_user = user_id is not None
+        if first_hour < last_hour:
+            first_day, last_day = _next_local_midnight(first_hour), _local_midnight(last_hour)
+            if first_day >= last_day:
+                first_day = last_day = last_hour
+
+            raw_windows = [(start_timestamp, first_hour), (last_hour, stop_timestamp)]
+            parts = [_raw_activity_sql(first_hour, last_hour, for_user, open_only=True),
+                     _rollup_activity_sql('Hourly', first_hour, first_day, for_user),
+                     _rollup_activity_sql('Daily', first_day, last_day, for_user),
+                     _rollup_activity_sql('Hourly', last_day, last_hour, for_user)]
+        else:
+            raw_windows = [(start_timestamp, stop_timestamp)]
+            parts = []
+
+        # Entries at the edges of the window may have been archived
+        archives = self._read_connection.execute(
+            'SELECT name, start+0, stop+0, longest+0 FROM ActivityArchives WHERE activity=\'UserActivity\'').fetchall()
+        for window_start, window_stop in raw_windows:
+            if window_start >= window_stop:
+                continue
+
+            parts.append(_raw_activity_sql(window_start, window_stop, for_user))
+            parts += [_archived_activity_sql(name, window_start, window_stop, longest, for_user)
+                      for name, archive_start, archive_stop, longest in archives
+                      if archive_start < window_stop and archive_stop > window_start]
+
+        summaries = {}
+        for summary_user_id, status, seconds in self._read_connection.execute(
+                'SELECT UserIDs.id, status, SUM(seconds) FROM (' + ' UNION ALL '.join(parts) + ') AS Parts '
+                'JOIN UserIDs ON Parts.id=UserIDs.rowid GROUP BY Parts.id, status',
+                {'now': round(datetime.now().timestamp()), 'user_id': user_id}):
+            summary = summaries.get(summary_user_id)
+            if summary is None:
+                summary = summaries[summary_user_id] = UserActivitySummary(start, stop)
+
+            summary.sum[UserStatus(status)] = timedelta(seconds=seconds)
+
+        return summaries
+
+    # Limit a summary window to the period between the first recorded activity and now. A window that lies entirely in
+    # the future becomes empty, rather than negative
+    def _clamp_summary_window(self, start: datetime, stop: datetime) -> Tuple[datetime, datetime]:
+        now = datetime.now()
+        if start == datetime.min:
+            first_start = self._read_connection.execute(
+                'SELECT MIN(first_start) FROM (SELECT MIN(start) AS first_start FROM UserActivity UNION ALL '
+                'SELECT MIN(start) FROM ActivityArchives WHERE activity=\'UserActivity\')').fetchone()[0]
+            start = now if first_start is None else datetime.fromtimestamp(first_start)
+
+        stop = min(stop, now)
+        return min(start, stop), stop
 
     # Initialize logging of voice activity (e.g. Unaccompanied, Accompanied, AFK, Disconnected)
     # active_users must be an up-to-date list of the {user_id,status} of non-disconnected users
     def voice_activity_init(self, active_users: Dict[int, VoiceStatus]):
+        self._activity_init('VoiceActivity', active_users, VoiceStatus.Disconnected)
+
+    def voice_activity_update(self, user_id: int, status: VoiceStatus, timestamp=None):
+        if timestamp is None:
+            timestamp = datetime.now()
+
+        self._remember_activity('VoiceActivity', user_id, status, timestamp, VoiceStatus.Disconnected)
+        if self._write_behind:
+            self._pending_voice_updates.append((user_id, status, timestamp))
+            self._flush_if_full()
+        else:
+            changes = self._prepare_activity_updates([(user_id, status, timestamp)], VoiceStatus.Disconnected)
+            with self._connection:
+                self._write_activity_updates('VoiceActivity', *changes)
+
+    def get_last_voice_activity(self, user_id: int) -> Optional[Tuple[VoiceStatus, datetime, timedelta]]:
+        return self._last_activity['VoiceActivity'].get(user_id)
+
+    # Apply an activity update to the cached latest entry of a user, the same way that it will be applied to the db
+    def _remember_activity(self, table, user_id: int, status, timestamp: datetime, ended_status):
+        last_activity = self._last_activity[table]
+        timestamp = round(timestamp.timestamp())
+
+        entry = last_activity.get(user_id)
+        if entry is not None and entry[2] is None:
+            last_activity[user_id] = (entry[0], entry[1], timedelta(seconds=max(timestamp - round(entry[1].timestamp()), 0)))
+
+        if status != ended_status:
+            last_activity[user_id] = (status, datetime.fromtimestamp(timestamp), None)
+
+    # Load the latest entry of every user in the given activity table. Users who have not been around for a long time
+    # may only have archived entries, so the archives are read first, oldest first, and overridden by newer entries
+    def _load_last_activity(self, table):
+        last_activity = {}
+        for source in self._get_archive_tables(self._connection, table)[::-1] + [table]:
+            last_activity.update((user_id, (status, start, duration)) for user_id, status, start, duration in
+                                 self._connection.execute(
+                                     f'SELECT UserIDs.id, status, start, duration FROM {source} '
+                                     f'JOIN UserIDs ON {source}.id=UserIDs.rowid WHERE {source}.rowid IN '
+                                     f'(SELECT (SELECT rowid FROM {source} WHERE id=UserIDs.rowid '
+                                     f'ORDER BY start DESC LIMIT 1) FROM UserIDs)'))
+
+        # Replace the whole dict at once, as it may be read from other threads (see AsyncFridge)
+        self._last_activity[table] = last_activity
+
+    # Reconcile the open entries of an activity table with the current {user_id,status} of the active users. This is
+    # done with a few set based statements in a single transaction, using a temporary table of the current statuses
+    def _activity_init(self, table, active_users, ended_status):
+        self.flush()
+
         current_timestamp = datetime.now()
         last_connected_timestamp = self._connection.execute(
             'SELECT timestamp FROM SalsaActivity WHERE status=? ORDER BY timestamp DESC LIMIT 1',
             (SalsaStatus.Connected,)).fetchone()
 
-        if last_connected_timestamp is None:
-            # If there is no connected timestamp, this must be a new db and the VoiceActivity table must also be empty
-            table_has_content = self._connection.execute('SELECT EXISTS(SELECT 1 FROM VoiceActivity)').fetchone()[0]
-            if table_has_content:
-                raise Exception('Database corruption!')
-        elif current_timestamp - last_connected_timestamp[0] > ACCEPTABLE_DOWNTIME:
-            # If we have been disconnected for longer than the acceptable downtime, we must finish old activity entries
-            # in the db and assume that those users left VC when we were disconnected
-            with self._connection:
-                self._connection.execute(
-                    'UPDATE VoiceActivity SET duration=MAX(?-start,0) WHERE duration IS NULL',
-                    (last_connected_timestamp[0],))
-        else:
-            # If we have been disconnected for less than the acceptable downtime, then we may assume that any users who
-            # were previously in VC and are STILL in VC have not moved during our period of downtime
+        # If we have been disconnected for less than the acceptable downtime, then we may assume that any users who
+        # were previously active and are STILL active have been active during our period of downtime, and that any
+        # changes happened halfway through it
+        change_timestamp = current_timestamp
+        if last_connected_timestamp is not None:
             change_timestamp = last_connected_timestamp[0] + (current_timestamp - last_connected_timestamp[0]) / 2
-            for user_id, db_status in self._connection.execute(
-                    'SELECT id, status FROM VoiceActivityView WHERE duration IS NULL'):
-                current_status = active_users.pop(user_id, VoiceStatus.Disconnected)
-                if db_status != current_status:
-                    self.voice_activity_update(user_id, current_status, change_timestamp)
 
-        # For any users who are currently in VC and not present in the database, open entries for them
-        for user_id, current_status in active_users.items():
-            self.voice_activity_update(user_id, current_status, current_timestamp)
-
-    def voice_activity_update(self, user_id: int, status: VoiceStatus, timestamp=None):
-        if timestamp is None:
-            timestamp = datetime.now()
-
-        # Close any open entry for this user and then open a new entry with the updated status
-        alias_id = self.get_alias_id(user_id)
+        alias_ids = self._get_alias_ids(active_users.keys())
         with self._connection:
+            if last_connected_timestamp is None:
+                # If there is no connected timestamp, this must be a new db and the activity table must also be empty
+                table_has_content = self._connection.execute(f'SELECT EXISTS(SELECT 1 FROM {table})').fetchone()[0]
+                if table_has_content:
+                    raise Exception('Database corruption!')
+            elif current_timestamp - last_connected_timestamp[0] > ACCEPTABLE_DOWNTIME:
+                # If we have been disconnected for longer than the acceptable downtime, we must finish old activity
+                # entries in the db and assume that those users went inactive when we were disconnected
+                self._close_open_entries(table, last_connected_timestamp[0])
+
+            self._connection.execute('CREATE TEMP TABLE IF NOT EXISTS CurrentActivity '
+                                     '(id Integer PRIMARY KEY, status Integer)')
+            self._connection.execute('DELETE FROM temp.CurrentActivity')
+            self._connection.executemany('INSERT INTO temp.CurrentActivity VALUES(?,?)',
+                                         ((alias_ids[user_id], status) for user_id, status in active_users.items()
+                                          if status != ended_status))
+
+            # Open entries for users whose status is different from their open entry. Users who had an open entry
+            # changed at change_timestamp, and the other users are treated as if they just became active
             self._connection.execute(
-                'UPDATE VoiceActivity SET duration=MAX(?-start,0) WHERE '
-                'duration IS NULL AND id=?', (timestamp, alias_id))
+                f'INSERT INTO {table} SELECT id, status, CASE WHEN EXISTS(SELECT 1 FROM {table} AS Open '
+                f'WHERE Open.duration IS NULL AND Open.id=Current.id) THEN :change ELSE :current END, NULL '
+                f'FROM temp.CurrentActivity AS Current WHERE NOT EXISTS(SELECT 1 FROM {table} AS Open '
+                f'WHERE Open.duration IS NULL AND Open.id=Current.id AND Open.status=Current.status)',
+                {'change': change_timestamp, 'current': current_timestamp})
+
+            # Then close the old open entries which no longer match the current status of their user
+            outdated_entries = f'duration IS NULL AND NOT EXISTS(SELECT 1 FROM temp.CurrentActivity AS Current ' \
+                               f'WHERE Current.id={table}.id AND Current.status={table}.status)'
+            stop = round(change_timestamp.timestamp())
+            self._add_to_rollups(table, [(alias_id, status, start, max(stop - start, 0))
+                                         for alias_id, status, start in self._connection.execute(
+                                             f'SELECT id, status, start+0 FROM {table} WHERE {outdated_entries}')])
+            self._connection.execute(f'UPDATE {table} SET duration=MAX(?-start,0) WHERE {outdated_entries}',
+                                     (change_timestamp,))
+
+        self._load_last_activity(table)
+
+    # Write all queued activity updates to the db in a single transaction. Does nothing if the queue is empty
+    def flush(self):
+        if not self._pending_user_updates and not self._pending_voice_updates:
+            return
+
+        user_updates, self._pending_user_updates = self._pending_user_updates, []
+        voice_updates, self._pending_voice_updates = self._pending_voice_updates, []
+
+        try:
+            # Alias IDs must be resolved before the transaction is opened, as get_alias_id() commits on its own
+            user_changes = self._prepare_activity_updates(user_updates, UserStatus.Offline)
+            voice_changes = self._prepare_activity_updates(voice_updates, VoiceStatus.Disconnected)
+            with self._connection:
+                self._write_activity_updates('UserActivity', *user_changes)
+                self._write_activity_updates('VoiceActivity', *voice_changes)
+        except Exception:
+            # The transaction was rolled back, so put the batch back in front of anything queued since, to be written by
+            # the next flush
+            self._pending_user_updates[:0] = user_updates
+            self._pending_voice_updates[:0] = voice_updates
+            raise
+
+    def _before_read(self):
+        if self._flush_before_reads:
+            self.flush()
+
+    def _flush_if_full(self):
+        if len(self._pending_user_updates) + len(self._pending_voice_updates) >= self._max_pending_updates:
+            self.flush()
+
+    # Convert a list of (user_id, status, timestamp) updates into the rows needed to apply them. Returns a list of
+    # (timestamp, alias_id) parameters for closing the currently open entries and a list of rows to be inserted
+    def _prepare_activity_updates(self, updates, ended_status):
+        # Group the updates by user, keeping them in the order that they happened
+        user_changes = {}
+        for user_id, status, timestamp in updates:
+            user_changes.setdefault(self.get_alias_id(user_id), []).append((status, timestamp))
+
+        closed_entries = []
+        new_entries = []
+        for alias_id, changes in user_changes.items():
+            # Only the first change needs to close the entry that is currently open in the db. Entries opened by the
+            # later changes are closed right away by the change that follows them
+            closed_entries.append((changes[0][1], alias_id))
+
+            for index, (status, timestamp) in enumerate(changes):
+                if status == ended_status:
+                    continue
+
+                duration = None
+                if index + 1 < len(changes):
+                    # Same calculation as MAX(?-start,0) on the stored Unix timestamps
+                    duration = max(round(changes[index + 1][1].timestamp()) - round(timestamp.timestamp()), 0)
+
+                new_entries.append((alias_id, status, timestamp, duration))
+
+        return closed_entries, new_entries
+
+    # Close open entries and insert new entries in the given activity table, and add every entry that was closed to the
+    # rollups. Must be called inside a transaction
+    def _write_activity_updates(self, table, closed_entries, new_entries):
+        # Look up the entries that are about to be closed. There is at most one open entry for each user. The ids are
+        # looked up in chunks to stay below sqlite's limit on the number of query parameters
+        open_entries = {}
+        closed_ids = list({alias_id for _, alias_id in closed_entries})
+        for i in range(0, len(closed_ids), MAX_QUERY_PARAMETERS):
+            chunk = closed_ids[i:i + MAX_QUERY_PARAMETERS]
+            for alias_id, status, start in self._connection.execute(
+                    f'SELECT id, status, start+0 FROM {table} WHERE duration IS NULL AND id IN '
+                    f'({",".join("?" * len(chunk))})', chunk):
+                open_entries.setdefault(alias_id, []).append((status, start))
+
+        finished_entries = []
+        for timestamp, alias_id in closed_entries:
+            for status, start in open_entries.get(alias_id, ()):
+                finished_entries.append((alias_id, status, start, max(round(timestamp.timestamp()) - start, 0)))
+
+        for alias_id, status, timestamp, duration in new_entries:
+            if duration is not None:
+                finished_entries.append((alias_id, status, round(timestamp.timestamp()), duration))
+
+        self._connection.executemany(
+            f'UPDATE {table} SET duration=MAX(?-start,0) WHERE duration IS NULL AND id=?', closed_entries)
+        self._connection.executemany(f'INSERT INTO {table} VALUES(?,?,?,?)', new_entries)
+        self._add_to_rollups(table, finished_entries)
+
+    # Close every open entry in the given activity table at the given time. Must be called inside a transaction
+    def _close_open_entries(self, table, timestamp: datetime):
+        stop = round(timestamp.timestamp())
+        self._add_to_rollups(table, [(alias_id, status, start, max(stop - start, 0)) for alias_id, status, start in
+                                     self._connection.execute(
+                                         f'SELECT id, status, start+0 FROM {table} WHERE duration IS NULL')])
+
+        self._connection.execute(f'UPDATE {table} SET duration=MAX(?-start,0) WHERE duration IS NULL', (timestamp,))
+
+    # Add finished (alias_id, status, start, duration) entries to the hourly and daily rollups of the given activity
+    # table. start is a Unix timestamp and duration is in seconds. Must be called inside a transaction
+    def _add_to_rollups(self, table, finished_entries):
+        hourly = {}
+        for alias_id, status, start, duration in finished_entries:
+            for hour, seconds in _split_by_hour(start, start + duration):
+                key = (alias_id, status, hour)
+                hourly[key] = hourly.get(key, 0) + seconds
+
+        daily = {}
+        for (alias_id, status, hour), seconds in hourly.items():
+            key = (alias_id, status, _local_midnight(hour))
+            daily[key] = daily.get(key, 0) + seconds
+
+        for period, sums in (('Hourly', hourly), ('Daily', daily)):
+            self._connection.executemany(
+                f'INSERT INTO {table}{period} VALUES(?,?,?,?) '
+                f'ON CONFLICT(id, status, start) DO UPDATE SET seconds=seconds+excluded.seconds',
+                (key + (seconds,) for key, seconds in sums.items()))
+
+    # Recalculate all the rollups from the raw activity entries, including the archived entries
+    def rebuild_rollups(self):
+        with self._connection:
+            for table, _ in ACTIVITY_TABLES:
+                self._connection.execute(f'DELETE FROM {table}Hourly')
+                self._connection.execute(f'DELETE FROM {table}Daily')
 
-            if status != VoiceStatus.Disconnected:
-                self._connection.execute('INSERT INTO VoiceActivity VALUES(?,?,?,NULL)', (alias_id, status, timestamp))
+                for source in [table] + self._get_archive_tables(self._connection, table):
+                    cursor = self._connection.execute(
+                        f'SELECT id, status, start+0, duration+0 FROM {source} WHERE duration IS NOT NULL')
+                    while True:
+                        finished_entries = cursor.fetchmany(50000)
+                        if not finished_entries:
+                            break
 
-    def get_last_voice_activity(self, user_id: int) -> Optional[Tuple[VoiceStatus, datetime, timedelta]]:
-        activity_info = self._connection.execute('SELECT status, start, duration FROM VoiceActivityView '
-                                                 'WHERE id=? ORDER BY start DESC LIMIT 1', (user_id,)).fetchone()
-        return activity_info
+                        self._add_to_rollups(table, finished_entries)
 
-    # Get the alias ID for a given discord user_id. The alias ID is the rowid of the discord user_id inside the UserIDs
-    # table. We are using alias IDs in place of discord IDs in order to make our db size as small as possible
-    def get_alias_id(self, user_id: int):
+    # Move finished activity entries which ended more than retention ago out of the activity tables, into an archive
+    # table for the month in which they started. Archived entries are already part of the rollups, and are still used
+    # by summaries and last activity lookups. Returns the number of entries that were archived
+    def archive_activity(self, retention: timedelta) -> int:
+        self.flush()
+
+        cutoff = round((datetime.now() - retention).timestamp())
+
+        archived_count = 0
+        with self._connection:
+            for table, status_type in ACTIVITY_TABLES:
+                months = {}
+                for entry in self._connection.execute(
+                        f'SELECT rowid, id, status, start+0, duration+0 FROM {table} '
+                        f'WHERE start<:cutoff AND start+duration<:cutoff', {'cutoff': cutoff}):
+                    month = datetime.fromtimestamp(entry[3]).strftime('%Y%m')
+                    months.setdefault(month, []).append(entry)
+
+                for month, entries in months.items():
+                    archive = f'{table}Archive{month}'
+                    self._connection.execute(f'CREATE TABLE IF NOT EXISTS {archive} '
+                                             f'(id Integer, status {status_type}, start Timestamp, duration Duration)')
+                    self._connection.execute(f'CREATE INDEX IF NOT EXISTS {archive}ByUser ON {archive} (id, start)')
+                    self._connection.execute(f'CREATE INDEX IF NOT EXISTS {archive}ByStart ON {archive} (start)')
+
+                    self._connection.executemany(f'INSERT INTO {archive} VALUES(?,?,?,?)',
+                                                 (entry[1:] for entry in entries))
+                    self._connection.executemany(f'DELETE FROM {table} WHERE rowid=?',
+                                                 ((entry[0],) for entry in entries))
+
+                    self._connection.execute(
+                        f'INSERT OR REPLACE INTO ActivityArchives SELECT ?, ?, MIN(start), MAX(start+duration), '
+                        f'MAX(duration) FROM {archive}', (archive, table))
+
+                    archived_count += len(entries)
+
+        return archived_count
+
+    # Get every persisted scheduler job as a list of (name, kind, arguments, next_run)
+    def get_scheduled_jobs(self) -> List[Tuple[str, str, list, datetime]]:
+        return [(name, kind, json.loads(arguments), next_run) for name, kind, arguments, next_run in
+                self._read_connection.execute('SELECT name, kind, arguments, next_run FROM ScheduledJobs')]
+
+    # Add a scheduler job, or replace the job with the same name
+    def save_scheduled_job(self, name: str, kind: str, arguments: list, next_run: datetime):
         with self._connection:
-            while True:
-                alias_id = self._connection.execute('SELECT rowid FROM UserIDs WHERE id=?', (user_id,)).fetchone()
-                if alias_id is None:
-                    self._connection.execute('INSERT INTO UserIDs VALUES (?)', (user_id,))
-                else:
-                    # Remove the tuple
-                    return alias_id[0]
+            self._connection.execute('INSERT OR REPLACE INTO ScheduledJobs VALUES(?,?,?,?)',
+                                     (name, kind, json.dumps(arguments), next_run))
 
-    def init_db(self):
-        sql_tables = [
-            'CREATE TABLE IF NOT EXISTS SalsaActivity (status SalsaStatus, timestamp Timestamp)',
+    def delete_scheduled_job(self, name: str):
+        with self._connection:
+            self._connection.execute('DELETE FROM ScheduledJobs WHERE name=?', (name,))
+
+    # Get the names of the archive tables of the given activity table, newest first
+    @staticmethod
+    def _get_archive_tables(connection, table) -> List[str]:
+        return [name for name, in connection.execute(
+            'SELECT name FROM ActivityArchives WHERE activity=? ORDER BY start DESC', (table,))]
+
+    # Get the alias IDs for many discord user_ids at once, adding all the new users in a single transaction
+    def _get_alias_ids(self, user_ids) -> Dict[int, int]:
+        new_user_ids = [(user_id,) for user_id in user_ids if user_id not in self._alias_ids]
+        if new_user_ids:
+            with self._connection:
+                self._connection.executemany('INSERT INTO UserIDs VALUES (?)', new_user_ids)
+            self._alias_ids = dict(self._connection.execute('SELECT id, rowid FROM UserIDs'))
 
-            'CREATE TABLE IF NOT EXISTS UserIDs (id Integer NOT NULL UNIQUE)',
+        return self._alias_ids
 
-            'CREATE TABLE IF NOT EXISTS UserActivity '
-            '(id Integer, status UserStatus, start Timestamp, duration Duration)',
+    # Get the alias ID for a given discord user_id. The alias ID is the rowid of the discord user_id inside the UserIDs
+    # table. We are using alias IDs in place of discord IDs in order to make our db size as small as possible
+    def get_alias_id(self, user_id: int):
+        alias_id = self._alias_ids.get(user_id)
+        if alias_id is None:
+            # New user, add them to the table and remember the rowid they were given
+            with self._connection:
+                alias_id = self._connection.execute('INSERT INTO UserIDs VALUES (?)', (user_id,)).lastrowid
+            self._alias_ids[user_id] = alias_id
 
-            'CREATE TABLE IF NOT EXISTS VoiceActivity '
-            '(id Integer, status VoiceStatus, start Timestamp, duration Duration)',
+        return alias_id
 
-            'CREATE VIEW IF NOT EXISTS UserActivityView AS '
-            'SELECT UserIDs.id, UserActivity.status, UserActivity.start, UserActivity.duration '
-            'FROM UserActivity LEFT JOIN UserIDs ON UserActivity.id=UserIDs.rowid',
+    # Bring the db schema up to date by applying every migration newer than the version stored in the db
+    def init_db(self):
+        version = self._connection.execute('PRAGMA user_version').fetchone()[0]
+        if version > len(SCHEMA_MIGRATIONS):
+            raise Exception(f'Database schema version {version} is newer than this version of SalsaProvider!')
 
-            'CREATE VIEW IF NOT EXISTS VoiceActivityView AS '
-            'SELECT UserIDs.id, VoiceActivity.status, VoiceActivity.start, VoiceActivity.duration '
-            'FROM VoiceActivity LEFT JOIN UserIDs ON VoiceActivity.id=UserIDs.rowid'
-        ]
-        with self._connection:
-            for sql in sql_tables:
-                self._connection.execute(sql)
+        for new_version, migration in enumerate(SCHEMA_MIGRATIONS[version:], version + 1):
+            # sqlite3 does not open transactions for DDL statements, so do it explicitly to apply each migration
+            # atomically along with the version bump
+            with self._connection:
+                self._connection.execute('BEGIN')
+                for sql in migration:
+                    self._connection.execute(sql)
+                self._connection.execute(f'PRAGMA user_version={new_version}')
+
+        # Fill in the rollups for the activity recorded before they existed
+        if version < ROLLUP_SCHEMA_VERSION:
+            self.rebuild_rollups()
+
+    # Check that every query in HOT_QUERIES is answered using an index. Returns the query plans of any queries which
+    # scan a whole table or build a temporary b-tree to sort their results
+    def check_query_plans(self) -> Dict[str, List[str]]:
+        bad_plans = {}
+        for sql, parameters in HOT_QUERIES:
+            plan = [row[3] for row in self._connection.execute('EXPLAIN QUERY PLAN ' + sql, parameters)]
+            if any((step.startswith('SCAN') and 'USING' not in step and step != 'SCAN CONSTANT ROW') or
+                   'TEMP B-TREE' in step for step in plan):
+                bad_plans[sql] = plan
+
+        return bad_plans
 
     def __enter__(self):
         # Open database file and initialize
         self._connection = sqlite3.connect(self._db_file, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        if self._wal:
+            for pragma in ['PRAGMA journal_mode=WAL', 'PRAGMA synchronous=NORMAL'] + CONNECTION_PRAGMAS:
+                self._connection.execute(pragma)
+
         self.init_db()
 
+        # The read connection may be used from a different thread than the one that opened it (see AsyncFridge)
+        self._read_connection = sqlite3.connect(f'{Path(self._db_file).absolute().as_uri()}?mode=ro', uri=True,
+                                                detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                                                check_same_thread=False)
+        for pragma in CONNECTION_PRAGMAS:
+            self._read_connection.execute(pragma)
+
+        # Every alias lookup is served from memory, so load all the known users up front
+        self._alias_ids = dict(self._connection.execute('SELECT id, rowid FROM UserIDs'))
+
         # Register custom timestamp converter/adapter. We are using Unix epoch timestamps instead of ISO because they
         # are also supported by sqlite3 and use significantly less storage space inside the db
         def adapt_timestamp(timestamp: datetime):
@@ -283,12 +780,132 @@ class Fridge:
         sqlite3.register_converter('UserStatus', convert_user_status)
         sqlite3.register_converter('VoiceStatus', convert_voice_status)
 
+        # The latest activity of each user is also served from memory
+        for table, _ in ACTIVITY_TABLES:
+            self._load_last_activity(table)
+
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+        self._read_connection.close()
         self._connection.close()
 
 
+# Asynchronous front end for the Fridge. The Fridge and its write connection live on a single worker thread, and each
+# method runs the matching Fridge method on that thread, so the event loop never waits on the db. Updates are executed
+# in the order that they are made. Queries run on a second worker thread using the read connection, so long queries
+# do not hold up updates
+class AsyncFridge:
+    # With write-behind, queued updates are flushed flush_interval after the first of them was queued
+    def __init__(self, *args, flush_interval: timedelta = timedelta(milliseconds=500), **kwargs):
+        self._fridge = Fridge(*args, **kwargs)
+        self._fridge._flush_before_reads = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='Fridge')
+        self._read_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='FridgeRead')
+        self._flush_interval = flush_interval
+        self._flush_timer: Optional[asyncio.TimerHandle] = None
+
+    def _call(self, function, *args, **kwargs):
+        return asyncio.get_running_loop().run_in_executor(self._executor, partial(function, *args, **kwargs))
+
+    # Only the update which starts a new batch arms the timer, the rest of the batch is written along with it
+    def _arm_flush_timer(self):
+        if self._fridge._write_behind and self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().call_later(self._flush_interval.total_seconds(),
+                                                                      self._flush_when_due)
+
+    def _flush_when_due(self):
+        self._flush_timer = None
+        asyncio.create_task(self._timed_flush())
+
+    async def _timed_flush(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            # The batch was put back in the queue, so try again after another interval
+            print(f'Failed to flush the fridge: {e}')
+            traceback.print_exception(type(e), e, e.__traceback__)
+            self._arm_flush_timer()
+
+    async def _read(self, function, *args, **kwargs):
+        # Make sure that all the updates made so far are visible to the query
+        await self.flush()
+        return await asyncio.get_running_loop().run_in_executor(self._read_executor,
+                                                                partial(function, *args, **kwargs))
+
+    async def salsa_activity_update_connected(self):
+        await self._call(self._fridge.salsa_activity_update_connected)
+
+    async def user_activity_init(self, active_users: Dict[int, UserStatus]):
+        await self._call(self._fridge.user_activity_init, active_users)
+
+    async def user_activity_update(self, user_id: int, status: UserStatus, timestamp=None):
+        await self._call(self._fridge.user_activity_update, user_id, status, timestamp)
+        self._arm_flush_timer()
+
+    # Served from memory, so there is no need to go through a worker thread
+    async def get_last_user_activity(self, user_id: int) -> Optional[Tuple[UserStatus, datetime, timedelta]]:
+        return self._fridge.get_last_user_activity(user_id)
+
+    async def get_user_activity_summary(self, user_id: int, start: datetime = datetime.min,
+                                        stop: datetime = datetime.max) -> UserActivitySummary:
+        return await self._read(self._fridge.get_user_activity_summary, user_id, start, stop)
+
+    async def get_user_activity_summaries(self, start: datetime = datetime.min,
+                                          stop: datetime = datetime.max) -> Dict[int, UserActivitySummary]:
+        return await self._read(self._fridge.get_user_activity_summaries, start, stop)
+
+    async def voice_activity_init(self, active_users: Dict[int, VoiceStatus]):
+        await self._call(self._fridge.voice_activity_init, active_users)
+
+    async def voice_activity_update(self, user_id: int, status: VoiceStatus, timestamp=None):
+        await self._call(self._fridge.voice_activity_update, user_id, status, timestamp)
+        self._arm_flush_timer()
+
+    # Served from memory, so there is no need to go through a worker thread
+    async def get_last_voice_activity(self, user_id: int) -> Optional[Tuple[VoiceStatus, datetime, timedelta]]:
+        return self._fridge.get_last_voice_activity(user_id)
+
+    async def flush(self):
+        await self._call(self._fridge.flush)
+
+    async def rebuild_rollups(self):
+        await self._call(self._fridge.rebuild_rollups)
+
+    async def archive_activity(self, retention: timedelta) -> int:
+        return await self._call(self._fridge.archive_activity, retention)
+
+    async def get_alias_id(self, user_id: int) -> int:
+        return await self._call(self._fridge.get_alias_id, user_id)
+
+    async def get_scheduled_jobs(self) -> List[Tuple[str, str, list, datetime]]:
+        return await self._read(self._fridge.get_scheduled_jobs)
+
+    async def save_scheduled_job(self, name: str, kind: str, arguments: list, next_run: datetime):
+        await self._call(self._fridge.save_scheduled_job, name, kind, arguments, next_run)
+
+    async def delete_scheduled_job(self, name: str):
+        await self._call(self._fridge.delete_scheduled_job, name)
+
+    async def check_query_plans(self) -> Dict[str, List[str]]:
+        return await self._call(self._fridge.check_query_plans)
+
+    def __enter__(self):
+        # The connection must be opened on the worker thread, as sqlite3 connections are tied to their thread
+        self._executor.submit(self._fridge.__enter__).result()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self._executor.submit(self._fridge.__exit__, exc_type, exc_val, exc_tb).result()
+        finally:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+            self._executor.shutdown()
+            self._read_executor.shutdown()
+
+
 if __name__ == '__main__':
     # with Fridge('test.db') as fridge:
     #     fridge.salsa_activity_update_connected()
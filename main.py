@@ -6,15 +6,17 @@ import asyncio
 import commands
 import fridge
 import on_message
-from fridge import Fridge
+import outbound
+from fridge import AsyncFridge
 from fridge import VoiceStatus
+from outbound import Priority
 import salsa_settings as ss
 
 from datetime import datetime
 from datetime import timedelta
 
 import utilities
-from typing_tracker import TypingTracker
+from typing_tracker import SharedTyping, TypingTracker
 from typing_insulter import TypingInsulter
 
 
@@ -45,11 +47,17 @@ class SalsaClient(discord.ext.commands.Bot):
         self.owner_id = ss.NAME_TO_ID['Ian']
 
         super().__init__(command_prefix=['$'], intents=intents)
-        self._fridge: Fridge = fridge
+        self._fridge: AsyncFridge = fridge
         self._typing_tracker = TypingTracker(self)
-        self._typing_insulter = TypingInsulter()
-        self._long_term_scheduler = utilities.LongTermScheduler()
+        self._shadow_typing = SharedTyping()
+        self.outbound = outbound.Outbound(ss.OUTBOUND_RATE_LIMITS, ss.OUTBOUND_GLOBAL_RATE_LIMIT,
+                                          ss.OUTBOUND_MAX_QUEUED)
+        self._typing_insulter = TypingInsulter(self.outbound)
+        self._long_term_scheduler = utilities.LongTermScheduler(ss.SCHEDULER_MAX_RUNNING_TASKS,
+                                                                ss.SCHEDULER_TASK_TIMEOUT)
         self._has_run_scheduler = False
+        self._jobs = utilities.PersistentJobs(self._long_term_scheduler, fridge)
+        self._register_jobs()
         self._update_connected_task = None
 
         # Used to track the w101 news that has been seen today
@@ -58,18 +66,27 @@ class SalsaClient(discord.ext.commands.Bot):
         # Used to track do not disturb and invisible users
         self._quiet_users = set()
 
+    @property
+    def long_term_scheduler(self) -> utilities.LongTermScheduler:
+        return self._long_term_scheduler
+
     def get_the_tunnel(self) -> discord.Guild:
         return self.get_guild(ss.THE_TUNNEL_ID)
 
     async def update_connected(self):
         # We will update our last known connected timestamp every 5 minutes
-        self._fridge.salsa_activity_update_connected()
-        return self.update_connected(), datetime.now() + timedelta(minutes=5)
+        await self._fridge.salsa_activity_update_connected()
+        return self.update_connected, datetime.now() + timedelta(minutes=5)
+
+    async def archive_activity(self):
+        # Move old activity out of the fridge's main tables
+        archived_count = await self._fridge.archive_activity(ss.FRIDGE_ACTIVITY_RETENTION)
+        print(f'Archived {archived_count} activity entries')
 
     async def run_daily(self):
         # Change which people get shadow typing day by day
         number_of_victims = round(len(ss.ID_TO_NAME) / 4)
-        ss.SHADOW_TYPING_WHITELIST = random.sample(list(ss.NAME_TO_ID.values()), number_of_victims)
+        ss.SHADOW_TYPING_WHITELIST = frozenset(random.sample(list(ss.NAME_TO_ID.values()), number_of_victims))
 
         # Clear news headers
         self._w101_news_headers.clear()
@@ -79,16 +96,12 @@ class SalsaClient(discord.ext.commands.Bot):
     async def birthday(self, user_id):
         # Send a birthday message
         user = self.get_user(user_id)
-        if user is not None:
-            await self.get_channel(ss.TEXT_CHANNEL_IDS["general"]).send(f"Happy Birthday, {user.mention}! :birthday:")
-
-        await asyncio.sleep(1)
-        return self.birthday(user_id), utilities.get_next_birthday(user_id)
+        if user is not None and user_id in ss.BIRTHDAYS:
+            await self.outbound.send(self.get_channel(ss.TEXT_CHANNEL_IDS["general"]),
+                                     f"Happy Birthday, {user.mention}! :birthday:")
 
     async def fish_gaming_wednesday(self):
-        await self.get_channel(ss.TEXT_CHANNEL_IDS["general"]).send(ss.FISH_GAMING_WEDNESDAY_LINK)
-        return self.fish_gaming_wednesday(), \
-            (datetime.now() + timedelta(weeks=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        await self.outbound.send(self.get_channel(ss.TEXT_CHANNEL_IDS["general"]), ss.FISH_GAMING_WEDNESDAY_LINK)
 
     async def w101_news_check(self):
         async for header, content in utilities.check_w101_news():
@@ -100,15 +113,39 @@ class SalsaClient(discord.ext.commands.Bot):
             ian = self.get_user(ss.NAME_TO_ID["Ian"])
             if ian is not None:
                 embed = discord.Embed(title=f"Wizard101 News: {header}", description=content)
-                await ian.send(embed=embed)
+                await self.outbound.send(ian, embed=embed)
 
-        return self.w101_news_check(), datetime.now() + timedelta(hours=6)
+        return self.w101_news_check, datetime.now() + timedelta(hours=6)
 
     async def one_time_message(self, msg):
         general = self.get_channel(ss.TEXT_CHANNEL_IDS["general"])
-        await general.send(msg)
+        await self.outbound.send(general, msg)
         return None
 
+    async def holiday_message(self, holiday):
+        if holiday in ss.HOLIDAYS:
+            await self.one_time_message(ss.HOLIDAYS[holiday][1])
+
+    # Jobs which are stored in the fridge, so that they are not skipped when we happen to be down. Messages for a day
+    # are still sent if we come back within 12 hours, but a late birthday wish is better than none
+    def _register_jobs(self):
+        self._jobs.register('archive_activity', self.archive_activity, ss.FRIDGE_ARCHIVE_SCHEDULE.next_after,
+                            utilities.CatchUp.RunOnce, timeout=timedelta(hours=1), retry=ss.SCHEDULER_RETRY_POLICY)
+
+        self._jobs.register('birthday', self.birthday,
+                            lambda after, user_id: utilities.get_next_birthday(user_id, after)
+                            if user_id in ss.BIRTHDAYS else None, utilities.CatchUp.RunOnce, timedelta(days=1),
+                            retry=ss.SCHEDULER_RETRY_POLICY)
+
+        self._jobs.register('fish_gaming_wednesday', self.fish_gaming_wednesday,
+                            ss.FISH_GAMING_WEDNESDAY_SCHEDULE.next_after, utilities.CatchUp.RunOnce,
+                            timedelta(hours=12), retry=ss.SCHEDULER_RETRY_POLICY)
+
+        self._jobs.register('holiday_message', self.holiday_message,
+                            lambda after, holiday: ss.HOLIDAYS[holiday][0].next_after(after)
+                            if holiday in ss.HOLIDAYS else None,
+                            utilities.CatchUp.RunOnce, timedelta(hours=12), retry=ss.SCHEDULER_RETRY_POLICY)
+
     async def setup_hook(self):
         # Load app commands
         commands.load_app_commands(self)
@@ -126,94 +163,32 @@ class SalsaClient(discord.ext.commands.Bot):
         # Setup daily task
         self._long_term_scheduler.schedule(self.run_daily(), datetime.now())
 
-        # Setup birthday tasks
-        for user_id in ss.BIRTHDAYS.keys():
-            self._long_term_scheduler.schedule(self.birthday(user_id), utilities.get_next_birthday(user_id))
+        # Setup the persistent jobs. Jobs which were stored before are only looked up, not recalculated
+        await self._jobs.load()
 
-        now = datetime.now()
-        schedule_msg = lambda t, msg: self._long_term_scheduler.schedule(self.one_time_message(msg), t)
+        # Daily archival of old activity, early in the morning when nobody is around
+        await self._jobs.add('archive_activity', 'archive_activity')
+
+        # Birthdays
+        for user_id in ss.BIRTHDAYS.keys():
+            await self._jobs.add(f'birthday:{user_id}', 'birthday', user_id)
 
         # Fish gaming Wednesday
         if ss.FISH_GAMING_WEDNESDAY:
-            starting_time = now.replace(hour=0, minute=0, second=0, microsecond=0)
-            if starting_time.weekday() == 2:
-                starting_time = starting_time + timedelta(days=1)
-            while starting_time.weekday() != 2:
-                starting_time = starting_time + timedelta(days=1)
+            await self._jobs.add('fish_gaming_wednesday', 'fish_gaming_wednesday')
+        else:
+            await self._jobs.remove('fish_gaming_wednesday')
 
-            self._long_term_scheduler.schedule(self.fish_gaming_wednesday(), starting_time)
+        now = datetime.now()
 
         # Wizard101 news notifications
         if ss.W101_NEWS_NOTIFICATIONS:
             first_check = now + timedelta(hours=6)
-            self._long_term_scheduler.schedule(self.w101_news_check(), first_check)
-
-        # Christmas related messages
-        before_christmas = now.replace(month=12, day=18, hour=0, minute=0, second=0, microsecond=0)
-        before_christmas  = utilities.next_annual_event(before_christmas)
-
-        christmas_eve = now.replace(month=12, day=24, hour=0, minute=0, second=0, microsecond=0)
-        christmas_eve = utilities.next_annual_event(christmas_eve)
-
-        christmas = now.replace(month=12, day=25, hour=0, minute=0, second=0, microsecond=0)
-        christmas = utilities.next_annual_event(christmas)
+            self._long_term_scheduler.schedule(self.w101_news_check, first_check, retry=ss.SCHEDULER_RETRY_POLICY)
 
-        schedule_msg(before_christmas, "https://www.youtube.com/watch?v=M16CZ38PuFQ&"\
-            "pp=ygUaY2hyaXN0bWFzIGp1c3QgYSB3ZWVrIGF3YXk%3D")
-
-        schedule_msg(christmas_eve, "It's Christmas Eve! :santa: :cookie: :milk:")
-        schedule_msg(christmas, "Merry Christmas Everyone! :christmas_tree: :gift:")
-
-        # New years
-        new_year = datetime(year=now.year + 1, month=1, day=1, hour=0, \
-                minute=0, second=0, microsecond=0)
-
-        schedule_msg(new_year, "Happy New Year! :fireworks: :sparkler: :champagne_glass:")
-
-        # Halloween
-        halloween = now.replace(month=10, day=31, hour=0, minute=0, second=0, microsecond=0)
-        halloween = utilities.next_annual_event(halloween)
-
-        schedule_msg(halloween, "It's spooky time... :skull: :headstone: :black_cat: :ladder:")
-
-        # 4th of July
-        fourth_of_july = now.replace(month=7, day=4, hour=0, minute=0, second=0, microsecond=0)
-        fourth_of_july = utilities.next_annual_event(fourth_of_july)
-
-        schedule_msg(fourth_of_july, "Happy 4th of July! :flag_us: :fireworks:")
-
-        # Leap day
-        def try_leap_day(datetime):
-            try:
-                return datetime.replace(month=2, day=29, hour=0, minute=0, second=0, microsecond=0)
-            except ValueError:
-                return None
-
-        leap_day = try_leap_day(now)
-        if leap_day is not None and now > leap_day:
-            leap_day = None
-
-        tries = 1
-        while leap_day is None:
-            leap_day = try_leap_day(now.replace(year=now.year + tries))
-            tries += 1
-
-        schedule_msg(leap_day, "It's a leap day! :frog: This doesn't happen very often, so enjoy while it lasts!")
-
-        # Thanksgiving
-        def find_thanksgiving(year):
-            thanksgiving = datetime(year=year, month=11, day=1, hour=0, minute=0, second=0, microsecond=0)
-            while thanksgiving.weekday() != 3:
-                thanksgiving += timedelta(days=1)
-
-            thanksgiving += timedelta(weeks=3)
-            return thanksgiving
-
-        thanksgiving = find_thanksgiving(now.year)
-        if now > thanksgiving:
-            thanksgiving = find_thanksgiving(now.year + 1)
-
-        schedule_msg(thanksgiving, "Have a great Thanksgiving everyone! :turkey: And eat well :yum:")
+        # Holiday messages
+        for holiday in ss.HOLIDAYS.keys():
+            await self._jobs.add(f'holiday_message:{holiday}', 'holiday_message', holiday)
 
         # Allow long term tasks to be executed
         await self._long_term_scheduler.run()
@@ -242,7 +217,7 @@ class SalsaClient(discord.ext.commands.Bot):
             # Fill quiet users
             self._quiet_users_update(member)
 
-        self._fridge.user_activity_init(active_users)
+        await self._fridge.user_activity_init(active_users)
 
         # Fill the fridge with the members who are currently in VC
         active_users = {}
@@ -263,11 +238,12 @@ class SalsaClient(discord.ext.commands.Bot):
         if temp is not None:
             active_users[temp.id] = VoiceStatus.Accompanied if accompanied else VoiceStatus.Unaccompanied
 
-        self._fridge.voice_activity_init(active_users)
+        await self._fridge.voice_activity_init(active_users)
 
         # We want to update the connected timestamp, so we will start the task if it is not already running
         if self._update_connected_task is None:
-            self._update_connected_task = self._long_term_scheduler.schedule(self.update_connected(), datetime.now())
+            self._update_connected_task = self._long_term_scheduler.schedule(self.update_connected, datetime.now(),
+                                                                             retry=ss.SCHEDULER_RETRY_POLICY)
 
     async def on_disconnect(self):
         print("We have been disconnected!")
@@ -280,7 +256,7 @@ class SalsaClient(discord.ext.commands.Bot):
         if message.author == self.user:
             return
 
-        self._typing_tracker.on_message(message.author)
+        self._typing_tracker.on_message(message.author, message.channel)
 
         # We must call this to ensure that discord.Bot commands work properly
         await self.process_commands(message)
@@ -298,7 +274,7 @@ class SalsaClient(discord.ext.commands.Bot):
 
         # Automatically upvote shrimp
         if ss.SHOW_SHRIMP_SUPPORT and reaction.emoji == "🦐":
-            await reaction.message.add_reaction("🦐")
+            self.outbound.react(reaction.message, "🦐")
 
     async def deafen_quiet_user(self, member, voice_state, general_channel):
         if voice_state is None:
@@ -313,7 +289,7 @@ class SalsaClient(discord.ext.commands.Bot):
                       f"them! They will be automatically deafened until their status has changed :grin:"
             content = discord.Embed(title=':exclamation: Invalid Status Detected!', description=message,
                                     color=discord.Color.dark_red())
-            await general_channel.send(embed=content, delete_after=10)
+            await self.outbound.send(general_channel, embed=content, delete_after=10)
 
     async def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState,
                                     after: discord.VoiceState):
@@ -350,7 +326,7 @@ class SalsaClient(discord.ext.commands.Bot):
                         # Update this special member's status
                         status = VoiceStatus.Unaccompanied if left_normal_channel else VoiceStatus.Accompanied
                         print(f"Update {existing_member.name}'s status to {status.name}")
-                        self._fridge.voice_activity_update(existing_member.id, status, current_datetime)
+                        await self._fridge.voice_activity_update(existing_member.id, status, current_datetime)
                         break
 
             # Then update our own status
@@ -365,7 +341,7 @@ class SalsaClient(discord.ext.commands.Bot):
             # Update our own status
             if status is not None:
                 print(f"Update {member.name}'s status to {status.name}")
-                self._fridge.voice_activity_update(member.id, status, current_datetime)
+                await self._fridge.voice_activity_update(member.id, status, current_datetime)
 
         if newly_joined:
             # Sometimes send messages when people join VC
@@ -373,16 +349,16 @@ class SalsaClient(discord.ext.commands.Bot):
                     in ss.WELCOME_GARON_HOME_DAYS and random.random() < ss.WELCOME_GARON_HOME_PROBABILITY and \
                     ss.WELCOME_GARON_HOME_TIME_RANGE[0] <= current_datetime.time() <= \
                     ss.WELCOME_GARON_HOME_TIME_RANGE[1]:
-                await general_channel.send(f'Welcome home {member.mention}! How was work?')
+                await self.outbound.send(general_channel, f'Welcome home {member.mention}! How was work?')
             elif ss.check_enabled(ss.JOIN_MESSAGES, ss.JOIN_MESSAGES_WHITELIST, member.id) and \
                     (random.random() < ss.JOIN_MESSAGES_LIST[member.id][1]):
-                await general_channel.send(ss.JOIN_MESSAGES_LIST[member.id][0])
+                await self.outbound.send(general_channel, ss.JOIN_MESSAGES_LIST[member.id][0], priority=Priority.Joke)
             elif ss.BOZO_DETECTION and member.id in ss.BOZO_DETECTION_SENSITIVITY:
                 # Bozo detection :)
                 if random.random() < ss.BOZO_DETECTION_SENSITIVITY[member.id]:
                     bozo_channel = self.get_channel(ss.VOICE_CHANNEL_IDS["Bozo's"])
                     await member.move_to(bozo_channel)
-                    await general_channel.send(ss.BOZO_DETECTED_GIF)
+                    await self.outbound.send(general_channel, ss.BOZO_DETECTED_GIF, priority=Priority.Joke)
 
     async def on_presence_update(self, before: discord.Member, after: discord.Member):
         if before == self.user:
@@ -401,7 +377,7 @@ class SalsaClient(discord.ext.commands.Bot):
                                                         after.is_on_mobile())
 
         if before_status != after_status:
-            self._fridge.user_activity_update(after.id, after_status)
+            await self._fridge.user_activity_update(after.id, after_status)
 
     async def on_typing(self, channel, user, when):
         if user == self.user:
@@ -414,20 +390,25 @@ class SalsaClient(discord.ext.commands.Bot):
                              self._typing_insulter.user_started_typing(user, channel))
 
     async def user_stopped_typing(self, user, channel):
-        self._typing_insulter.user_stopped_typing(user)
+        self._typing_insulter.user_stopped_typing(user, channel)
 
-    # Make the bot type while other people are typing
+    # Make the bot type while other people are typing. Everyone typing in a channel shares one typing indicator
     async def start_shadow_typing(self, user, channel):
         if not ss.check_enabled(ss.SHADOW_TYPING_ENABLED, ss.SHADOW_TYPING_WHITELIST, user.id):
             return
 
-        async with channel.typing():
-            await self._typing_tracker.wait_until_stopped_typing(user)
+        await self._shadow_typing.hold_while(channel, self._typing_tracker.wait_until_stopped_typing(user, channel))
 
-    def about_to_shut_down(self):
+    async def about_to_shut_down(self):
         # Final db update of the last connected timestamp
         if self._update_connected_task is not None:
-            self._fridge.salsa_activity_update_connected()
+            await self._fridge.salsa_activity_update_connected()
+
+        # Stop any jokes which are still being performed
+        await on_message.cancel_performances()
+
+        # Write any activity updates that are still queued
+        await self._fridge.flush()
 
     @property
     def fridge(self):
@@ -449,7 +430,8 @@ class SalsaClient(discord.ext.commands.Bot):
 
 def main():
     # Fridge is the SQLite3 database backend for SalsaProvider
-    with Fridge('salsa.db') as fridge:
+    with AsyncFridge('salsa.db', ss.FRIDGE_WRITE_BEHIND, ss.FRIDGE_FLUSH_MAX_UPDATES,
+                     flush_interval=ss.FRIDGE_FLUSH_INTERVAL) as fridge:
         # Start the SalsaClient
         client = SalsaClient(fridge)
 
@@ -458,7 +440,7 @@ def main():
                 try:
                     await client.start(ss.TOKEN, reconnect=True)
                 finally:
-                    client.about_to_shut_down()
+                    await client.about_to_shut_down()
 
         discord.utils.setup_logging()
 
@@ -1,109 +1,187 @@
 import random
 import asyncio
+import traceback
+from functools import partial
 
 import utilities
+from outbound import Priority
 import salsa_settings as ss
 
 
+# Long running actions which were detached from the message that started them
+_performances = set()
+
+
+# An action to take on messages. Rules which are not enabled are left out, authors limits the rule to those authors
+# (everyone if None), and triggers makes it only run for messages containing at least one of those triggers
+class MessageRule:
+    def __init__(self, action, enabled=True, authors=None, triggers=None):
+        self.action = action
+        self.enabled = enabled
+        self.authors = frozenset(authors) if authors else None
+        self.triggers = frozenset(triggers) if triggers else None
+
+
+# Compile the rules into the rules for each author with rules of their own, and the rules for everyone else
+def compile_rules(rules):
+    rules = [rule for rule in rules if rule.enabled]
+    rules_for_everyone = tuple(rule for rule in rules if rule.authors is None)
+    authors = set().union(*(rule.authors for rule in rules if rule.authors is not None))
+    rules_by_author = {author: tuple(rule for rule in rules if rule.authors is None or author in rule.authors)
+                       for author in authors}
+    return rules_by_author, rules_for_everyone
+
+# Compiled once, so each message is only scanned once for all the trigger keywords
+_trigger_matcher = utilities.KeywordMatcher(ss.MESSAGE_TRIGGER_KEYWORDS, ss.MESSAGE_TRIGGERS_IGNORING_SPACES)
+
+
 async def handle(client, message):
     content_lower = message.content.lower()
     content_basic = content_lower.replace(" ", "")
+    triggers = _trigger_matcher.match(content_lower)
+
+    # Only the rules for this author are looked at, and of those only the ones whose triggers are in the message. The
+    # actions are independent of each other, so run them all at once. A slow or broken action must not hold up or break
+    # the others
+    rules = _rules_by_author.get(message.author.id, _rules_for_everyone)
+    actions = [rule.action for rule in rules if rule.triggers is None or not triggers.isdisjoint(rule.triggers)]
+    await asyncio.gather(*(_run_action(action, client, message, content_basic, triggers) for action in actions))
+
+
+async def _run_action(action, client, message, content_basic, triggers):
+    try:
+        await asyncio.wait_for(action(client, message, content_basic, triggers),
+                               ss.ON_MESSAGE_ACTION_TIMEOUT.total_seconds())
+    except asyncio.TimeoutError:
+        print(f'Message action {action.__name__} timed out')
+    except Exception as e:
+        print(f'Message action {action.__name__} failed: {e!r}')
+        traceback.print_exception(type(e), e, e.__traceback__)
+
+
+# Run a long performance in the background, so it does not count against the time budget of its action
+def _perform(coroutine):
+    task = asyncio.create_task(coroutine)
+    _performances.add(task)
+    task.add_done_callback(_performance_finished)
 
-    actions = [_shrimp, _upvote_downvote, _brian, _link_checks, _mug_moments, _ivy_features, _delena_features,
-               _thank_you_replies]
-    for action in actions:
-        await action(client, message, content_lower, content_basic)
 
+def _performance_finished(task):
+    _performances.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        e = task.exception()
+        print(f'Performance failed: {e!r}')
+        traceback.print_exception(type(e), e, e.__traceback__)
 
-async def _shrimp(client, message, content_lower, content_basic):
+
+# Stop any performances that are still going, for shutting down
+async def cancel_performances():
+    tasks = list(_performances)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _shrimp(client, message, content_basic, triggers):
     # Inject a shrimp emoji into messages randomly
-    if (("🦐" in message.content or "shrimp" in content_lower) and ss.SHRIMP_ON_SHRIMP_ACTION) or \
+    if ('shrimp' in triggers and ss.SHRIMP_ON_SHRIMP_ACTION) or \
             (random.random() < ss.SHRIMP_INJECTION_PROBABILITY):
-        await message.add_reaction("🦐")
+        client.outbound.react(message, "🦐")
 
 
-async def _upvote_downvote(client, message, content_lower, content_basic):
-    if ss.UPVOTE_DOWNVOTE_MESSAGES and (random.random() < ss.UPVOTE_DOWNVOTE_PROBABILITY):
+async def _upvote_downvote(client, message, content_basic, triggers):
+    if random.random() < ss.UPVOTE_DOWNVOTE_PROBABILITY:
         ratio = ss.TARGETED_UPVOTE_TO_DOWNVOTE_RATIOS.get(message.author.id, ss.UPVOTE_TO_DOWNVOTE_RATIO)
         upvote_probability = ratio / (ratio + 1)
-        await message.add_reaction("👍" if random.random() < upvote_probability else "👎")
+        client.outbound.react(message, "👍" if random.random() < upvote_probability else "👎")
 
 
-async def _brian(client, message, content_lower, content_basic):
+async def _brian(client, message, content_basic, triggers):
     # Attempt to get the custom emoji
     emoji = client.get_emoji(ss.BOBS_BRIAN_ID)
     if not emoji:
         return
 
     # Add Bob's Brian to related messages
-    if any((item in content_basic) for item in (str(emoji), "brian", "brain")):
-        await message.add_reaction(emoji)
+    client.outbound.react(message, emoji)
 
 
-async def _link_checks(client, message, content_lower, content_basic):
+async def _reddit_virgin(client, message, content_basic, triggers):
     # Call reddit users virgins randomly
-    if ss.check_enabled(ss.REDDIT_VIRGIN_DETECTOR, ss.REDDIT_VIRGIN_DETECTOR_WHITELIST, message.author.id) \
-            and "reddit.com" in content_lower and (random.random() < ss.REDDIT_VIRGIN_RESPONSE_PROBABILITY):
-        for emoji in utilities.convert_to_regional_indicators("VIRGiN"):
-            await message.add_reaction(emoji)
+    if random.random() < ss.REDDIT_VIRGIN_RESPONSE_PROBABILITY:
+        client.outbound.react(message, *utilities.convert_to_regional_indicators("VIRGiN"))
+
+
+async def _youtube_loser(client, message, content_basic, triggers):
     # Call Youtube users losers randomly
-    elif ss.check_enabled(ss.YOUTUBE_LOSER_DETECTOR, ss.YOUTUBE_LOSER_DETECTOR_WHITELIST, message.author.id) \
-            and ("youtube.com" in content_lower or "youtu.be" in content_lower) and \
-            (random.random() < ss.YOUTUBE_LOSER_RESPONSE_PROBABILITY):
-        for emoji in utilities.convert_to_regional_indicators("LOSER"):
-            await message.add_reaction(emoji)
+    if random.random() < ss.YOUTUBE_LOSER_RESPONSE_PROBABILITY:
+        client.outbound.react(message, *utilities.convert_to_regional_indicators("LOSER"))
 
 
-async def _mug_moments(client, message, content_lower, content_basic):
+async def _mug_moments(client, message, content_basic, triggers):
     # MUG MOMENTS
-    if ss.MUG_MOMENTS_ENABLED and content_basic in ("#mugmoment", "#certifiedmugmoment"):
-        await message.channel.send(ss.MUG_MOMENT_GIF)
-    elif ss.MUG_MOMENTS_ENABLED and random.random() < ss.MUG_MOMENT_PROBABILITY:
-        await message.channel.send('What is this? :thinking:', delete_after=60)
-        await asyncio.sleep(50)
-        await message.channel.send('I think, I just sensed something...', delete_after=20)
-        await asyncio.sleep(10)
-        await message.channel.send('Could it be???', delete_after=15)
-        await asyncio.sleep(5)
-        await message.channel.send('IT IS', delete_after=15)
-        await asyncio.sleep(5)
-        await message.channel.send('THAT WAS A #CERTIFIEDMUGMOMENT')
-        await message.channel.send(ss.MUG_MOMENT_GIF)
-
-
-async def _ivy_features(client, message, content_lower, content_basic):
-    if message.author.id != ss.NAME_TO_ID["Ivy"]:
-        return
-
+    if content_basic in ("#mugmoment", "#certifiedmugmoment"):
+        await client.outbound.send(message.channel, ss.MUG_MOMENT_GIF, priority=Priority.Reply)
+    elif random.random() < ss.MUG_MOMENT_PROBABILITY:
+        _perform(_mug_moment_performance(client, message))
+
+
+async def _mug_moment_performance(client, message):
+    send = partial(client.outbound.send, message.channel, priority=Priority.Joke)
+    await send('What is this? :thinking:', delete_after=60)
+    await asyncio.sleep(50)
+    await send('I think, I just sensed something...', delete_after=20)
+    await asyncio.sleep(10)
+    await send('Could it be???', delete_after=15)
+    await asyncio.sleep(5)
+    await send('IT IS', delete_after=15)
+    await asyncio.sleep(5)
+    await send('THAT WAS A #CERTIFIEDMUGMOMENT')
+    await send(ss.MUG_MOMENT_GIF)
+
+
+async def _misspell_ivy(client, message, content_basic, triggers):
     # Ivy Misspellings
-    if ss.MISSPELL_IVY and random.random() < ss.MISSPELL_IVY_PROBABILITY:
-        for emoji in random.choice(ss.IVY_EMOJI_MISSPELLINGS):
-            await message.add_reaction(emoji)
+    if random.random() < ss.MISSPELL_IVY_PROBABILITY:
+        client.outbound.react(message, *random.choice(ss.IVY_EMOJI_MISSPELLINGS))
+
 
+async def _call_ivy_a_psycho(client, message, content_basic, triggers):
     # Call Ivy a psycho randomly
-    if ss.CALL_IVY_A_PSYCHO and random.random() < ss.CALL_IVY_A_PSYCHO_PROBABILITY:
-        await message.channel.send("Psycho", delete_after=3)
+    if random.random() < ss.CALL_IVY_A_PSYCHO_PROBABILITY:
+        await client.outbound.send(message.channel, "Psycho", delete_after=3, priority=Priority.Joke)
+
 
+async def _ivy_knives(client, message, content_basic, triggers):
     # Add knives and blood because Ivy is evil >:)
-    if ss.IVY_ADD_KNIVES and random.random() < ss.IVY_ADD_KNIVES_PROBABILITY:
-        await message.add_reaction("🔪")
-        await message.add_reaction("🩸")
+    if random.random() < ss.IVY_ADD_KNIVES_PROBABILITY:
+        client.outbound.react(message, "🔪", "🩸")
 
 
-async def _delena_features(client, message, content_lower, content_basic):
+async def _dels(client, message, content_basic, triggers):
     # Dels
-    if ss.DELS and message.author.id == ss.NAME_TO_ID["Delena"] and random.random() < ss.DELS_PROBABILITY:
-        for emoji in utilities.convert_to_regional_indicators("DELS"):
-            await message.add_reaction(emoji)
-
-
-async def _thank_you_replies(client, message, content_lower, content_basic):
-    # Reply to thank you messages
-    if ss.REPLY_TO_THANK_YOU_MESSAGES:
-        # Check if the message contains some variant of 'thanks'
-        contains_thanks = any((pattern in content_basic) for pattern in ('ty', 'thx', 'thank'))
-
-        # Check if the message contains 'salsa'
-        if contains_thanks and 'salsa' in content_basic:
-            await message.channel.send(ss.get_thank_you_reply(message.author))
-            await message.add_reaction("👍")
+    if random.random() < ss.DELS_PROBABILITY:
+        client.outbound.react(message, *utilities.convert_to_regional_indicators("DELS"))
+
+
+async def _thank_you_replies(client, message, content_basic, triggers):
+    # Reply to thank you messages, which contain some variant of 'thanks' and 'salsa'
+    if 'salsa' in triggers:
+        await client.outbound.send(message.channel, ss.get_thank_you_reply(message.author), priority=Priority.Reply)
+        client.outbound.react(message, "👍", priority=Priority.Reply)
+
+
+MESSAGE_RULES = [
+    MessageRule(_shrimp),
+    MessageRule(_upvote_downvote, ss.UPVOTE_DOWNVOTE_MESSAGES),
+    MessageRule(_brian, triggers={'brian'}),
+    MessageRule(_reddit_virgin, ss.REDDIT_VIRGIN_DETECTOR, ss.REDDIT_VIRGIN_DETECTOR_WHITELIST, {'reddit'}),
+    MessageRule(_youtube_loser, ss.YOUTUBE_LOSER_DETECTOR, ss.YOUTUBE_LOSER_DETECTOR_WHITELIST, {'youtube'}),
+    MessageRule(_mug_moments, ss.MUG_MOMENTS_ENABLED),
+    MessageRule(_misspell_ivy, ss.MISSPELL_IVY, {ss.NAME_TO_ID["Ivy"]}),
+    MessageRule(_call_ivy_a_psycho, ss.CALL_IVY_A_PSYCHO, {ss.NAME_TO_ID["Ivy"]}),
+    MessageRule(_ivy_knives, ss.IVY_ADD_KNIVES, {ss.NAME_TO_ID["Ivy"]}),
+    MessageRule(_dels, ss.DELS, {ss.NAME_TO_ID["Delena"]}),
+    MessageRule(_thank_you_replies, ss.REPLY_TO_THANK_YOU_MESSAGES, triggers={'thanks'}),
+]
+_rules_by_author, _rules_for_everyone = compile_rules(MESSAGE_RULES)
@@ -0,0 +1,175 @@
+import heapq
+import time
+import asyncio
+import traceback
+import discord
+from enum import IntEnum
+from functools import partial
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+
+# Lower values are sent first
+class Priority(IntEnum):
+    Reply = 0  # Responses to commands and people talking to us
+    Message = 1  # Announcements, birthdays, etc
+    Joke = 2  # Random messages nobody asked for
+    Reaction = 3  # Random reactions nobody asked for
+
+
+# Jokes and reactions are dropped when too much is queued, everything else is always sent
+DROPPABLE_PRIORITY = Priority.Joke
+
+
+# Allows count requests per period, with bursts up to count
+class TokenBucket:
+    def __init__(self, count: int, period: timedelta):
+        self._capacity = count
+        self._rate = count / period.total_seconds()
+        self._tokens = float(count)
+        self._updated = time.monotonic()
+
+    # Wait until a request may be made, and use it up
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+def _log_failure(future):
+    error = None if future.cancelled() else future.exception()
+    if error is not None:
+        print(f'Outbound action failed: {error}')
+        traceback.print_exception(type(error), error, error.__traceback__)
+
+
+class _Action:
+    __slots__ = ('steps', 'future')
+
+    def __init__(self, steps, future):
+        self.steps = steps
+        self.future = future
+
+
+# Queues the messages and reactions we send so they go out at the rate discord allows, most important first. Each route
+# (kind of request and channel) has its own rate limit and is sent in order by its own worker, like discord's buckets
+class Outbound:
+    # rate_limits maps each kind of request ('message' or 'reaction') to its (count, period) limit per channel
+    def __init__(self, rate_limits: Dict[str, Tuple[int, timedelta]], global_rate_limit: Tuple[int, timedelta],
+                 max_queued: int):
+        self._rate_limits = rate_limits
+        self._global_bucket = TokenBucket(*global_rate_limit)
+        self._max_queued = max_queued
+
+        self._buckets: Dict[Tuple[str, int], TokenBucket] = {}
+        self._queues: Dict[Tuple[str, int], List[list]] = {}
+        self._workers: Dict[Tuple[str, int], asyncio.Task] = {}
+        self._sequence = 0
+        self._queued = 0
+        self._dropped = 0
+
+    def queued_count(self):
+        return self._queued
+
+    def dropped_count(self):
+        return self._dropped
+
+    # Send a message to the channel. Returns the message, or None if it was dropped. Raises whatever sending raised
+    async def send(self, channel, *args, priority=Priority.Message, **kwargs) -> Optional[discord.Message]:
+        return await self.submit(('message', channel.id), priority, partial(channel.send, *args, **kwargs))
+
+    # Add the reactions to the message in order. A sequence of reactions is kept together, and dropped as a whole.
+    # Nobody waits for reactions, so failures are only logged
+    def react(self, message, *emojis, priority=Priority.Reaction) -> asyncio.Future:
+        future = self.submit(('reaction', message.channel.id), priority,
+                             *(partial(message.add_reaction, emoji) for emoji in emojis))
+        future.add_done_callback(_log_failure)
+        return future
+
+    # Queue the steps (coroutine functions) to run in order on the route. The returned future is set to the result of
+    # the last step, None if the action was dropped, or the exception of the step that failed
+    def submit(self, route, priority, *steps) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        action = _Action(steps, future)
+
+        if self._queued >= self._max_queued and not self._make_room(priority):
+            self._drop(action)
+            return future
+
+        heapq.heappush(self._queues.setdefault(route, []), [priority, self._sequence, action])
+        self._sequence += 1
+        self._queued += 1
+
+        if route not in self._workers:
+            self._workers[route] = asyncio.create_task(self._work(route))
+        return future
+
+    # Drop the least important droppable action queued to make room for one with the given priority. Returns False if
+    # the new action should be dropped instead
+    def _make_room(self, priority):
+        if priority >= DROPPABLE_PRIORITY:
+            return False
+
+        # Queues are small, so just search them all. Newest first among equals, as they are the most likely to be stale
+        # by the time they would have been sent
+        victim = None
+        for queue in self._queues.values():
+            for entry in queue:
+                if entry[0] >= DROPPABLE_PRIORITY and (victim is None or entry[:2] > victim[1][:2]):
+                    victim = (queue, entry)
+
+        if victim is None:
+            # Never drop important things, just let the queue grow
+            return True
+
+        queue, entry = victim
+        queue.remove(entry)
+        heapq.heapify(queue)
+        self._queued -= 1
+        self._drop(entry[2])
+        return True
+
+    def _drop(self, action):
+        self._dropped += 1
+
+        # Whoever was waiting may have given up already
+        if not action.future.done():
+            action.future.set_result(None)
+
+    def _bucket(self, route):
+        bucket = self._buckets.get(route)
+        if bucket is None:
+            bucket = self._buckets[route] = TokenBucket(*self._rate_limits[route[0]])
+        return bucket
+
+    async def _work(self, route):
+        queue = self._queues[route]
+        bucket = self._bucket(route)
+        try:
+            while queue:
+                _, _, action = heapq.heappop(queue)
+                self._queued -= 1
+
+                result = None
+                try:
+                    for step in action.steps:
+                        await bucket.acquire()
+                        await self._global_bucket.acquire()
+                        result = await step()
+                except Exception as e:
+                    if not action.future.done():
+                        action.future.set_exception(e)
+                    continue
+
+                if not action.future.done():
+                    action.future.set_result(result)
+        finally:
+            del self._workers[route]
+            if not queue:
+                del self._queues[route]
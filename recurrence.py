@@ -0,0 +1,126 @@
+import calendar
+from abc import ABC
+from abc import abstractmethod
+from datetime import date
+from datetime import datetime
+from datetime import time
+from datetime import timedelta
+from typing import Optional
+
+
+# Recurrence rules for scheduled jobs. Each rule finds its next occurrence after a given time directly, without stepping
+# through days or years
+
+
+class Recurrence(ABC):
+    def __init__(self, at: time = time()):
+        self._at = at
+
+    # Get the first occurrence after the given time
+    @abstractmethod
+    def next_after(self, after: datetime) -> datetime:
+        raise NotImplementedError
+
+    def _combine(self, day: date) -> datetime:
+        return datetime.combine(day, self._at)
+
+
+# Rules which happen at most once a year
+class YearlyRecurrence(Recurrence):
+    # Get the day of the occurrence in the given year, or None if there is none that year
+    @abstractmethod
+    def _day_in_year(self, year: int) -> Optional[date]:
+        raise NotImplementedError
+
+    def next_after(self, after: datetime) -> datetime:
+        # Only the next year or two are ever tried, as every rule occurs within a few years
+        year = after.year
+        while True:
+            day = self._day_in_year(year)
+            if day is not None and self._combine(day) > after:
+                return self._combine(day)
+
+            year = self._next_year(year)
+
+    def _next_year(self, year: int) -> int:
+        return year + 1
+
+
+class Daily(Recurrence):
+    def next_after(self, after: datetime) -> datetime:
+        occurrence = self._combine(after.date())
+        return occurrence if occurrence > after else occurrence + timedelta(days=1)
+
+
+# Weekday is 0 for Monday through 6 for Sunday
+class Weekly(Recurrence):
+    def __init__(self, weekday: int, at: time = time()):
+        super().__init__(at)
+        self._weekday = weekday
+
+    def next_after(self, after: datetime) -> datetime:
+        occurrence = self._combine(after.date() + timedelta(days=(self._weekday - after.weekday()) % 7))
+        return occurrence if occurrence > after else occurrence + timedelta(weeks=1)
+
+
+class Yearly(YearlyRecurrence):
+    def __init__(self, month: int, day: int, at: time = time()):
+        super().__init__(at)
+        self._month = month
+        self._day = day
+
+    def _day_in_year(self, year: int) -> Optional[date]:
+        # Use LeapDay for February 29th, which skips straight to the next leap year
+        try:
+            return date(year, self._month, self._day)
+        except ValueError:
+            return None
+
+
+# The nth weekday of a month, e.g. the 4th Thursday of November. A negative n counts from the end of the month
+class NthWeekday(YearlyRecurrence):
+    def __init__(self, month: int, weekday: int, n: int, at: time = time()):
+        super().__init__(at)
+        self._month = month
+        self._weekday = weekday
+        self._n = n
+
+    def _day_in_year(self, year: int) -> Optional[date]:
+        if self._n > 0:
+            first = date(year, self._month, 1)
+            return first + timedelta(days=(self._weekday - first.weekday()) % 7 + (self._n - 1) * 7)
+
+        last = date(year, self._month, calendar.monthrange(year, self._month)[1])
+        return last - timedelta(days=(last.weekday() - self._weekday) % 7 + (-self._n - 1) * 7)
+
+
+# Easter Sunday, or a day relative to it (e.g. offset -2 for Good Friday)
+class Easter(YearlyRecurrence):
+    def __init__(self, offset: int = 0, at: time = time()):
+        super().__init__(at)
+        self._offset = offset
+
+    def _day_in_year(self, year: int) -> Optional[date]:
+        # Anonymous Gregorian algorithm
+        a = year % 19
+        b, c = divmod(year, 100)
+        d, e = divmod(b, 4)
+        g = (8 * b + 13) // 25
+        h = (19 * a + b - d - g + 15) % 30
+        i, k = divmod(c, 4)
+        l = (32 + 2 * e + 2 * i - h - k) % 7
+        m = (a + 11 * h + 19 * l) // 433
+        month = (h + l - 7 * m + 90) // 25
+        day = (h + l - 7 * m + 33 * month + 19) % 32
+        return date(year, month, day) + timedelta(days=self._offset)
+
+
+# February 29th
+class LeapDay(YearlyRecurrence):
+    def _day_in_year(self, year: int) -> Optional[date]:
+        return date(year, 2, 29) if calendar.isleap(year) else None
+
+    def _next_year(self, year: int) -> int:
+        # Jump straight to the next multiple of 4, and skip centuries which are not leap years
+        year += 4 - year % 4
+        return year if calendar.isleap(year) else year + 4
@@ -1,7 +1,9 @@
 import random
+import recurrence
 import utilities
 import private_settings as ps
 from datetime import time
+from datetime import timedelta
 
 # The settings below are 'private settings'. They are stored in a different file because they contain sensitive info
 # Discord API Token
@@ -24,13 +26,50 @@ BOBS_BRIAN_ID = ps.BOBS_BRIAN_ID
 BIRTHDAYS = ps.BIRTHDAYS
 
 
+# Fridge (database) settings - Queue activity updates in memory and write them in batches
+FRIDGE_WRITE_BEHIND = True
+FRIDGE_FLUSH_INTERVAL = timedelta(milliseconds=500)
+FRIDGE_FLUSH_MAX_UPDATES = 200  # Flush early if this many updates are queued
+FRIDGE_ACTIVITY_RETENTION = timedelta(days=90)  # Older activity entries are moved into monthly archive tables
+FRIDGE_ARCHIVE_SCHEDULE = recurrence.Daily(time(hour=4))  # Early in the morning when nobody is around
+
+
+# Scheduler settings - Limits for the jobs run by the long term scheduler
+SCHEDULER_MAX_RUNNING_TASKS = 4
+SCHEDULER_TASK_TIMEOUT = timedelta(minutes=5)  # Default limit on how long a single run of a job may take
+SCHEDULER_RETRY_POLICY = utilities.RetryPolicy(max_attempts=5, initial_delay=timedelta(seconds=10),
+                                               max_delay=timedelta(minutes=10))
+
+
+# Outbound settings - Rate limits for the messages and reactions we send, matching discord's per channel buckets
+OUTBOUND_RATE_LIMITS = {'message': (5, timedelta(seconds=5)), 'reaction': (1, timedelta(milliseconds=250))}
+OUTBOUND_GLOBAL_RATE_LIMIT = (50, timedelta(seconds=1))
+OUTBOUND_MAX_QUEUED = 100  # Start dropping jokes and random reactions when this many actions are waiting
+
+
+# Message settings - Each action taken on a message gets this long before it is given up on
+ON_MESSAGE_ACTION_TIMEOUT = timedelta(seconds=30)
+
+# Keywords which trigger message actions, matched against the lowercase message. Keywords of the triggers in
+# MESSAGE_TRIGGERS_IGNORING_SPACES also match with spaces in them
+MESSAGE_TRIGGER_KEYWORDS = {
+    'shrimp': ('shrimp', '🦐'),
+    'brian': ('brian', 'brain', f':{BOBS_BRIAN_ID}>'),  # Bob's Brian emoji looks like <:name:id>
+    'reddit': ('reddit.com',),
+    'youtube': ('youtube.com', 'youtu.be'),
+    'thanks': ('ty', 'thx', 'thank'),
+    'salsa': ('salsa',),
+}
+MESSAGE_TRIGGERS_IGNORING_SPACES = {'brian', 'thanks', 'salsa'}
+
+
 # Shadow Typing settings - Makes the bot type while users are typing
 SHADOW_TYPING_ENABLED = True
-SHADOW_TYPING_WHITELIST = []  # Blank list means everyone is victim
+SHADOW_TYPING_WHITELIST = frozenset()  # Blank set means everyone is victim
 
 # Typing Insults settings - Insults users for taking too long to type
 TYPING_INSULTS_ENABLED = True
-TYPING_INSULTS_WHITELIST = []
+TYPING_INSULTS_WHITELIST = frozenset()
 TYPING_INSULTS_TIMEOUTS = [30]*4
 
 
@@ -57,14 +96,14 @@ TARGETED_UPVOTE_TO_DOWNVOTE_RATIOS = {NAME_TO_ID["Tanner"]: 1/3, NAME_TO_ID["Ivy
 
 # Call reddit users virgins
 REDDIT_VIRGIN_DETECTOR = True
-REDDIT_VIRGIN_DETECTOR_WHITELIST = [user_id for user_id in ID_TO_NAME.keys()
-                                    if ID_TO_NAME[user_id] not in ["Ivy", "Delena"]]
+REDDIT_VIRGIN_DETECTOR_WHITELIST = frozenset(user_id for user_id in ID_TO_NAME.keys()
+                                             if ID_TO_NAME[user_id] not in ["Ivy", "Delena"])
 REDDIT_VIRGIN_RESPONSE_PROBABILITY = 1.0/10.0  # 1 in 10 chance
 
 
 # Call Youtube users losers
 YOUTUBE_LOSER_DETECTOR = True
-YOUTUBE_LOSER_DETECTOR_WHITELIST = []
+YOUTUBE_LOSER_DETECTOR_WHITELIST = frozenset()
 YOUTUBE_LOSER_RESPONSE_PROBABILITY = 1.0/10.0  # 1 in 10 chance
 
 
@@ -110,7 +149,7 @@ JOIN_MESSAGES_LIST = {NAME_TO_ID["Reen"]: ("OMG bro, it's the sick gamer R33N!",
                       NAME_TO_ID["Ian"]: ("Can't think of anything to say for yourself, huh? Loser.", 1.0/100.0),
                       NAME_TO_ID["Alex"]: ("Welcome Alex! How has your day been?", 1.0),
                       NAME_TO_ID["Garon"]: ("Hello there, GruxDeluxe. I mean Garon 😅", 1.0/100.0)}
-JOIN_MESSAGES_WHITELIST = JOIN_MESSAGES_LIST.keys()
+JOIN_MESSAGES_WHITELIST = frozenset(JOIN_MESSAGES_LIST)
 
 
 # Bozo detection service
@@ -152,6 +191,23 @@ SHRIMP_IMAGES = ['https://www.acouplecooks.com/wp-content/uploads/2018/09/Grille
 # Fish gaming wednesday
 FISH_GAMING_WEDNESDAY = True
 FISH_GAMING_WEDNESDAY_LINK = 'https://www.youtube.com/watch?v=vEVGoSaJ9K8'
+FISH_GAMING_WEDNESDAY_SCHEDULE = recurrence.Weekly(2)
+
+# Holiday messages - Name: (Recurrence, Message). The names are stored with the scheduled jobs, so avoid renaming them
+HOLIDAYS = {
+    'before_christmas': (recurrence.Yearly(12, 18), "https://www.youtube.com/watch?v=M16CZ38PuFQ&"
+                                                    "pp=ygUaY2hyaXN0bWFzIGp1c3QgYSB3ZWVrIGF3YXk%3D"),
+    'christmas_eve': (recurrence.Yearly(12, 24), "It's Christmas Eve! :santa: :cookie: :milk:"),
+    'christmas': (recurrence.Yearly(12, 25), "Merry Christmas Everyone! :christmas_tree: :gift:"),
+    'new_year': (recurrence.Yearly(1, 1), "Happy New Year! :fireworks: :sparkler: :champagne_glass:"),
+    'halloween': (recurrence.Yearly(10, 31), "It's spooky time... :skull: :headstone: :black_cat: :ladder:"),
+    'fourth_of_july': (recurrence.Yearly(7, 4), "Happy 4th of July! :flag_us: :fireworks:"),
+    'leap_day': (recurrence.LeapDay(),
+                 "It's a leap day! :frog: This doesn't happen very often, so enjoy while it lasts!"),
+    'thanksgiving': (recurrence.NthWeekday(11, 3, 4),  # 4th Thursday of November
+                     "Have a great Thanksgiving everyone! :turkey: And eat well :yum:"),
+}
+
 
 # Wizard101 news
 W101_NEWS_NOTIFICATIONS = True
@@ -168,5 +224,6 @@ def get_thank_you_reply(user):
     return response
 
 
+# Whitelists are frozensets of user IDs, and an empty whitelist means everyone
 def check_enabled(enabled, whitelist, user_id):
     return enabled and (not whitelist or user_id in whitelist)
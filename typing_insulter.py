@@ -2,12 +2,14 @@ import sys
 import discord
 import utilities
 import salsa_settings as ss
+from outbound import Priority
 
 
 # Insults people who are taking the time to write a thought provoking message
 class TypingInsulter:
-    def __init__(self):
+    def __init__(self, outbound):
         self._candidates = {}
+        self._outbound = outbound
 
     async def user_started_typing(self, user, channel):
         if not ss.check_enabled(ss.TYPING_INSULTS_ENABLED, ss.TYPING_INSULTS_WHITELIST, user.id):
@@ -15,7 +17,8 @@ class TypingInsulter:
 
         # Create a new timer
         timer = utilities.Timer()
-        self._candidates[user] = [channel, timer, []]
+        key = (user, channel)
+        self._candidates[key] = [channel, timer, []]
 
         messages = [f"Hmm... You've been typing that message for quite a while {user.mention}. Everything okay?",
 
@@ -30,23 +33,25 @@ class TypingInsulter:
         for timeout, message in (tuple(zip(ss.TYPING_INSULTS_TIMEOUTS, messages)) + ((sys.maxsize, ""),)):
             timer_result = await timer.wait(timeout)
             if timer_result:
-                self._candidates[user][2].append(await channel.send(message))
+                sent = await self._outbound.send(channel, message, priority=Priority.Joke)
+                if sent is not None:
+                    self._candidates[key][2].append(sent)
             else:
                 break
 
         # Delete our messages and cleanup
         if isinstance(channel, discord.TextChannel):
-            await channel.delete_messages(self._candidates[user][2])
+            await channel.delete_messages(self._candidates[key][2])
         else:
-            for message in self._candidates[user][2]:
+            for message in self._candidates[key][2]:
                 await message.delete()
 
-        del self._candidates[user]
+        del self._candidates[key]
 
-    def user_stopped_typing(self, user):
+    def user_stopped_typing(self, user, channel):
         if not ss.check_enabled(ss.TYPING_INSULTS_ENABLED, ss.TYPING_INSULTS_WHITELIST, user.id):
             return
 
-        candidate = self._candidates.get(user)
+        candidate = self._candidates.get((user, channel))
         if candidate is not None:
             candidate[1].cancel()
@@ -2,20 +2,26 @@ import asyncio
 import utilities
 
 
+# Typing state is kept per (user, channel), so that someone typing in two channels at once is tracked separately in each
 class TypingTracker:
     def __init__(self, client, timeout_time=12):
         self._typing_users = {}
         self._client = client
+
+        # Set when each typing user stops typing, to wake up everything waiting for that
+        self._stopped_typing = {}
         self._timeout_time = timeout_time
 
     async def on_typing(self, user, channel):
-        # Retrieve the timer for this user
-        if self.is_typing(user):
-            timer = self._typing_users[user]
+        # Retrieve the timer for this user in this channel
+        key = (user, channel)
+        if key in self._typing_users:
+            timer = self._typing_users[key]
         else:
             # Create a timer for this user if this is the beginning of their typing
             timer = utilities.Timer()
-            self._typing_users[user] = timer
+            self._typing_users[key] = timer
+            self._stopped_typing[key] = asyncio.Event()
 
         # Either restart an existing timer, or start the timer for the first time
         if timer.is_running():
@@ -25,19 +31,73 @@ class TypingTracker:
             task = asyncio.create_task(self._client.user_started_typing(user, channel))
 
             await timer.wait(self._timeout_time)
-            del self._typing_users[user]
+            del self._typing_users[key]
+            self._stopped_typing.pop(key).set()
 
             # No longer typing
             await asyncio.gather(task, self._client.user_stopped_typing(user, channel))
 
-    def on_message(self, user):
-        timer = self._typing_users.get(user)
+    def on_message(self, user, channel):
+        key = (user, channel)
+        timer = self._typing_users.get(key)
         if timer is not None:
             timer.cancel()
+            self._stopped_typing[key].set()
+
+    # Check if the user is typing in the given channel, or in any channel if none is given
+    def is_typing(self, user, channel=None):
+        if channel is not None:
+            return (user, channel) in self._typing_users
+
+        return any(typing_user == user for typing_user, _ in self._typing_users)
+
+    async def wait_until_stopped_typing(self, user, channel):
+        stopped_typing = self._stopped_typing.get((user, channel))
+        if stopped_typing is not None:
+            await stopped_typing.wait()
+
+
+# A typing indicator per channel, shared by everything that wants the bot to be typing there. The indicator stays on
+# while anything holds it, so discord only gets one typing keep-alive per channel however many people are typing
+class SharedTyping:
+    def __init__(self):
+        # Channel -> [number of holders, event set when the last holder lets go]
+        self._channels = {}
+
+    # Keep the bot typing in the channel until the awaitable finishes
+    async def hold_while(self, channel, awaitable):
+        holders = self._channels.get(channel)
+        if holders is not None:
+            # The indicator is already on, just keep it alive until we are done
+            holders[0] += 1
+            try:
+                await awaitable
+            finally:
+                self._release(holders)
+            return
+
+        holders = [1, asyncio.Event()]
+        self._channels[channel] = holders
+        try:
+            async with channel.typing():
+                try:
+                    await awaitable
+                finally:
+                    self._release(holders)
+
+                # Stay typing for anyone who joined after us
+                while holders[0] > 0:
+                    holders[1].clear()
+                    await holders[1].wait()
 
-    def is_typing(self, user):
-        return user in self._typing_users
+                # Anyone arriving from now on opens a new indicator
+                del self._channels[channel]
+        finally:
+            if self._channels.get(channel) is holders:
+                del self._channels[channel]
 
-    async def wait_until_stopped_typing(self, user):
-        while self.is_typing(user):
-            await asyncio.sleep(0.1)
+    @staticmethod
+    def _release(holders):
+        holders[0] -= 1
+        if holders[0] == 0:
+            holders[1].set()
@@ -1,66 +1,203 @@
 import heapq
-from typing import List, Optional, Tuple
+import itertools
+import math
+import re
+import time
+import traceback
+from collections import deque
+from enum import Enum
+from functools import lru_cache
+from functools import partial
+from typing import Dict, FrozenSet, Iterable, List, Optional
 
 import fridge
 import asyncio
 import discord
 import requests
+import recurrence
 import salsa_settings as ss
 from datetime import datetime
+from datetime import timedelta
 from bs4 import BeautifulSoup
 from bs4 import Tag
 
-class Timer:
-    def __init__(self):
-        self._task = None
-        self._delay = None
-        self._restart = False
+# A callback armed on a TimingWheel. Cancelling it is O(1)
+class WheelTimer:
+    def __init__(self, wheel, deadline, callback):
+        self._wheel = wheel
+        self._deadline = deadline
+        self._callback = callback
 
-    async def wait(self, delay):
-        if self.is_running():
-            return False
+        # The wheel slot holding this timer, or None once it has fired or been cancelled
+        self._slot = None
 
-        self._delay = delay
-        while True:
-            # Create a new task
-            self._task = asyncio.create_task(self._timer(self._delay))
+    def cancel(self):
+        if self._slot is not None:
+            self._slot.discard(self)
+            self._slot = None
+            self._wheel._count -= 1
+
+    def is_armed(self):
+        return self._slot is not None
+
+
+# Hierarchical timing wheel for many short lived timers. Time is split into ticks of the given resolution (in seconds).
+# Each level has a number of slots, and each slot of a level covers the whole span of the level below it. Timers are
+# put in the lowest level whose span reaches their deadline, and are moved down a level when the wheel reaches their
+# slot. Arming and cancelling are O(1), and no asyncio task is needed per timer. The wheel is driven by a single
+# loop.call_at() callback, which only runs while timers are armed
+class TimingWheel:
+    def __init__(self, resolution=0.1, slot_bits=6, levels=4):
+        self._resolution = resolution
+        self._slot_bits = slot_bits
+        self._slot_mask = (1 << slot_bits) - 1
+        self._wheels = [[set() for _ in range(1 << slot_bits)] for _ in range(levels)]
+
+        # Timers which are too far away for the wheel, re-added whenever the top level has gone all the way around
+        self._overflow = set()
+
+        self._loop = None
+        self._handle = None
+        self._handle_tick = 0
+        self._tick = 0
+        self._count = 0
+
+    # Call callback() after the given delay in seconds, rounded up to the resolution of the wheel
+    def call_later(self, delay, callback) -> WheelTimer:
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+
+        now = self._loop.time()
+        if self._count == 0:
+            # Nothing is armed, so the wheel may have stopped turning. Catch up to the current time
+            self._tick = int(now / self._resolution)
+
+        timer = WheelTimer(self, max(math.ceil((now + delay) / self._resolution), self._tick + 1), callback)
+        self._add(timer)
+        self._count += 1
+
+        self._schedule_turn()
+        return timer
+
+    def _add(self, timer):
+        for level, slots in enumerate(self._wheels):
+            shift = self._slot_bits * level
+            if timer._deadline >> (shift + self._slot_bits) == self._tick >> (shift + self._slot_bits):
+                timer._slot = slots[(timer._deadline >> shift) & self._slot_mask]
+                break
+        else:
+            timer._slot = self._overflow
 
-            # Wait for it to finish
-            try:
-                await self._task
-                timer_expired = True
-            except asyncio.CancelledError:
-                timer_expired = False
+        timer._slot.add(timer)
 
-            # Restart the task, if needed
-            if self._restart:
-                self._restart = False
-            else:
+    # Make sure that the wheel turns again in time for the next timer, or the next time that timers move down a level
+    def _schedule_turn(self):
+        if self._count == 0:
+            return
+
+        next_tick = (self._tick | self._slot_mask) + 1
+        slots = self._wheels[0]
+        for tick in range(self._tick + 1, next_tick):
+            if slots[tick & self._slot_mask]:
+                next_tick = tick
                 break
 
-        # Delete the task
-        self._task = None
-        return timer_expired
+        if self._handle is not None:
+            if self._handle_tick <= next_tick:
+                return
+
+            self._handle.cancel()
+
+        self._handle = self._loop.call_at(next_tick * self._resolution, self._turn)
+        self._handle_tick = next_tick
+
+    def _turn(self):
+        self._handle = None
+
+        # The loop's clock may be a hair behind the tick that we were called for, due to rounding
+        now_tick = max(int(self._loop.time() / self._resolution), self._handle_tick)
+        while self._tick < now_tick and self._count > 0:
+            self._tick += 1
+            tick = self._tick
+
+            # Move the timers of the slots that have been reached down a level, starting from the top
+            if tick & ((1 << self._slot_bits * len(self._wheels)) - 1) == 0:
+                self._cascade(self._overflow)
+
+            for level in range(len(self._wheels) - 1, 0, -1):
+                shift = self._slot_bits * level
+                if tick & ((1 << shift) - 1) == 0:
+                    self._cascade(self._wheels[level][(tick >> shift) & self._slot_mask])
+
+            # Fire the timers that are due
+            slot = self._wheels[0][tick & self._slot_mask]
+            while slot:
+                timer = slot.pop()
+                timer._slot = None
+                self._count -= 1
+                timer._callback()
+
+        self._tick = max(self._tick, now_tick)
+        self._schedule_turn()
+
+    def _cascade(self, slot):
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            self._add(timer)
+
+
+_timing_wheel = None
+
+
+# Get the timing wheel shared by all Timers
+def get_timing_wheel() -> TimingWheel:
+    global _timing_wheel
+    if _timing_wheel is None:
+        _timing_wheel = TimingWheel()
+
+    return _timing_wheel
+
+
+class Timer:
+    def __init__(self, wheel: Optional[TimingWheel] = None):
+        self._wheel = wheel if wheel is not None else get_timing_wheel()
+        self._future = None
+        self._wheel_timer = None
+
+    # Wait for the given delay. Returns True if the timer expired, or False if it was cancelled
+    async def wait(self, delay):
+        if self.is_running():
+            return False
+
+        self._future = asyncio.get_running_loop().create_future()
+        self._wheel_timer = self._wheel.call_later(delay, self._expire)
+        try:
+            return await self._future
+        finally:
+            self._wheel_timer.cancel()
+            self._wheel_timer = None
+            self._future = None
 
     # Check if the timer is already running
     def is_running(self):
-        return self._task is not None
+        return self._future is not None
 
     # Restart the timer
     def restart(self, new_delay):
-        if self.is_running():
-            self._delay = new_delay
-            self._restart = True
-            self._task.cancel()
+        if self.is_running() and not self._future.done():
+            self._wheel_timer.cancel()
+            self._wheel_timer = self._wheel.call_later(new_delay, self._expire)
 
     # Cancel the timer
     def cancel(self):
-        if self.is_running():
-            self._restart = False
-            self._task.cancel()
+        if self.is_running() and not self._future.done():
+            self._wheel_timer.cancel()
+            self._future.set_result(False)
 
-    async def _timer(self, delay):
-        await asyncio.sleep(delay)
+    def _expire(self):
+        if not self._future.done():
+            self._future.set_result(True)
 
 
 ASCII_TO_REGIONAL_INDICATOR_OFFSET = 0x1F1E6 - ord('A')
@@ -80,19 +217,49 @@ def convert_to_regional_indicators(message):
     return ''.join(cvt_ascii_to_regional_indicators(character) for character in message)
 
 
-def next_annual_event(datetime_this_year):
-    if datetime.now() <= datetime_this_year:
-        return datetime_this_year
-
-    return datetime_this_year.replace(year=datetime_this_year.year + 1)
-
-
-def get_next_birthday(user_id):
-    month, day = ss.BIRTHDAYS.get(user_id)
-    current_datetime = datetime.now()
-
-    birthday_this_year = current_datetime.replace(day=day, month=month, hour=0, minute=0, second=0, microsecond=0)
-    return next_annual_event(birthday_this_year)
+# Finds which triggers have a keyword in a text, in a single scan. Keywords of the triggers in ignore_spaces also match
+# with spaces between their characters
+class KeywordMatcher:
+    def __init__(self, keywords: Dict[str, Iterable[str]], ignore_spaces: Iterable[str] = ()):
+        ignore_spaces = set(ignore_spaces)
+        patterns = {}
+        keyword_triggers = {}
+        for trigger, trigger_keywords in keywords.items():
+            for keyword in trigger_keywords:
+                if trigger in ignore_spaces:
+                    patterns[' *'.join(re.escape(character) for character in keyword)] = len(keyword)
+                else:
+                    patterns[re.escape(keyword)] = len(keyword)
+                keyword_triggers.setdefault(keyword.replace(' ', ''), set()).add(trigger)
+
+        # Only the first keyword matching at each position is found, so try the longest ones first and have them also
+        # report the triggers of the shorter keywords they start with
+        self._triggers = {keyword: frozenset().union(*(triggers for other_keyword, triggers in keyword_triggers.items()
+                                                       if keyword.startswith(other_keyword)))
+                          for keyword in keyword_triggers}
+
+        # No capturing groups, as they stop re from quickly skipping ahead to where a keyword could start. Which keyword
+        # matched is found from the matched text instead
+        self._pattern = re.compile('|'.join(sorted(patterns, key=patterns.get, reverse=True))) if patterns else None
+
+    def match(self, text: str) -> FrozenSet[str]:
+        # Keywords are rare, so most texts are scanned once without a match
+        match = self._pattern.search(text) if self._pattern is not None else None
+        if match is None:
+            return frozenset()
+
+        # After a match, the search carries on from the next character rather than the end of the match, so keywords
+        # which overlap each other are all found
+        triggers = self._triggers[match.group().replace(' ', '')]
+        match = self._pattern.search(text, match.start() + 1)
+        while match is not None:
+            triggers = triggers.union(self._triggers[match.group().replace(' ', '')])
+            match = self._pattern.search(text, match.start() + 1)
+        return triggers
+
+
+def get_next_birthday(user_id, after=None):
+    return recurrence.Yearly(*ss.BIRTHDAYS.get(user_id)).next_after(datetime.now() if after is None else after)
 
 
 # Check the wizard101 news feed for anything good going on today
@@ -176,97 +343,49 @@ def convert_user_status(status: discord.Status) -> fridge.UserStatus:
     return fridge.UserStatus.Offline
 
 
-split_respect_quotes_cache: Optional[Tuple[str, List[str]]] = None
+# Grouping quotes, escapes and whitespace: everything split_respect_quotes has to look at. An escaped backslash or quote
+# is matched as a pair, so the backslash can be dropped
+_SPLIT_SPECIAL_PATTERN = re.compile(r'\\[\\"\']|[\\"\' \t]')
 
 
+# Split text on whitespace, except inside matching quotes. Quotes without a match later on are kept as literal quotes,
+# and backslashes escape quotes and other backslashes. Cached because this is often called repeatedly with the same value
+@lru_cache(maxsize=256)
 def split_respect_quotes(text: str) -> List[str]:
-    # Caching because this function is often called repeatedly with the same value
-    global split_respect_quotes_cache
-    if split_respect_quotes_cache is not None and split_respect_quotes_cache[0] == text:
-        return split_respect_quotes_cache[1]
+    specials = [(match.start(), match.group()) for match in _SPLIT_SPECIAL_PATTERN.finditer(text)]
 
-    quote_indexes = []
-    skipped_sections = []
-
-    # Start by finding the locations of all escaped characters, whitespace, and potential grouping quotes
-    start = 0
-    backslash = False
-    whitespace = False
-    for stop, character in enumerate(text):
-        if backslash:
-            if character in ('\\', '"', '\''):
-                skipped_sections.append((stop-1, stop, False))
-            backslash = False
-        elif character == '\\':
-            backslash = True
-        elif character in ('"', '\''):
-            quote_indexes.append(stop)
-
-        if whitespace ^ (character in (' ', '\t')):
-            if whitespace:
-                skipped_sections.append((start, stop, True))
-            else:
-                start = stop
-            whitespace = not whitespace
-
-    if whitespace:
-        skipped_sections.append((start, len(text), True))
-
-    # Figure out which grouping quotes are 'real' and which ones should be interpreted as literal quotes
-    grouping_quotes = []
-    quote = 0
-    while quote < len(quote_indexes):
-        found = False
-        for search in range(quote+1, len(quote_indexes)):
-            if text[quote_indexes[quote]] == text[quote_indexes[search]]:
-                grouping_quotes.append((quote_indexes[quote], quote_indexes[search]))
-                quote = search + 1
-                found = True
-                break
-
-        if not found:
-            quote += 1
-
-    # Insert the grouping quotes into the skipped_sections, as we do not want grouping quotes included in output
-    index = 0
-    for quote in (quote for quote_pair in grouping_quotes for quote in quote_pair):
-        while index < len(skipped_sections) and skipped_sections[index][0] < quote:
-            index += 1
-
-        skipped_sections.insert(index, (quote, quote+1, False))
-
-    # Checks if we are inside grouping quotes and the skip should not be applied if it is whitespace
-    def inside_grouping_quotes(_skip_start):
-        while grouping_quotes:
-            quote_start, quote_stop = grouping_quotes[0]
-            if quote_stop < _skip_start:
-                del grouping_quotes[0]
-            else:
-                return quote_start < _skip_start < quote_stop
+    # A quote only starts a group if the same quote appears again later to close it
+    last_quotes = {special: index for index, special in specials if special in ('"', '\'')}
 
     result = []
     parts = []
     start = 0
-
-    # Chop up the original string using slicing and piece together the parts we need to form the result strings
-    for skip_start, skip_stop, whitespace in skipped_sections:
-        if whitespace and inside_grouping_quotes(skip_start):
+    quote = None
+    for index, special in specials:
+        if len(special) == 2:
+            # Escaped character, drop the backslash
+            parts.append(text[start:index])
+            start = index + 1
+        elif special == '\\':
+            # A backslash which does not escape anything is kept
             continue
-
-        parts.append(text[start:skip_start])
-
-        if whitespace:
-            result.append(''.join(parts))
-            parts = []
-
-        start = skip_stop
+        elif special in (' ', '\t'):
+            if quote is None:
+                parts.append(text[start:index])
+                result.append(''.join(parts))
+                parts = []
+                start = index + 1
+        elif quote is None and index < last_quotes[special] or quote == special:
+            # Opening or closing grouping quote, which is left out of the output
+            parts.append(text[start:index])
+            start = index + 1
+            quote = special if quote is None else None
 
     parts.append(text[start:])
     result.append(''.join(parts))
 
-    # Filter out empty strings from the results and return finally
-    split_respect_quotes_cache = (text, [split_text for split_text in result if split_text])
-    return split_respect_quotes_cache[1]
+    # Filter out the empty strings left by repeated whitespace
+    return [split_text for split_text in result if split_text]
 
 
 def cvt_escaped_str_to_literal(text: str) -> str:
@@ -287,37 +406,124 @@ def cvt_escaped_str_to_literal(text: str) -> str:
     return ''.join(temp + [text[start:]])
 
 
+# How often and how quickly a failed LongTermTask is retried. The delay before each retry grows exponentially, from
+# initial_delay up to max_delay
+class RetryPolicy:
+    def __init__(self, max_attempts: int = 3, initial_delay: timedelta = timedelta(seconds=30),
+                 max_delay: timedelta = timedelta(hours=1), multiplier: float = 2.0):
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+
+    # Get the delay before retrying, after the given number of failed attempts
+    def delay(self, attempts: int) -> timedelta:
+        return min(self.initial_delay * self.multiplier ** (attempts - 1), self.max_delay)
+
+
+# Statistics about the runs of the LongTermScheduler jobs with the same name. Only the latest samples of lateness (how
+# long after its scheduled time a run started) and run time are kept, in seconds
+class JobMetrics:
+    SAMPLE_COUNT = 64
+
+    def __init__(self):
+        self.lateness = deque(maxlen=self.SAMPLE_COUNT)
+        self.run_times = deque(maxlen=self.SAMPLE_COUNT)
+        self.runs = 0
+        self.failures = 0
+
+        # The soonest time that a job with this name is due, filled in by LongTermScheduler.job_metrics()
+        self.next_due: Optional[datetime] = None
+
+
+# A job of the LongTermScheduler. The job is either a coroutine or a function which creates one. Only jobs given as
+# functions can be retried, as a coroutine can only be run once. A job may return a (job, when) tuple to run again.
+# Once a recurring job has used up its retries, give_up(job) is called to get the (job, when) of its regular next run,
+# or None to stop. Without give_up, the job runs again as long after the failure as its last run asked for
 class LongTermTask:
-    def __init__(self, scheduler, coroutine, when):
+    def __init__(self, scheduler, coroutine, when, name=None, timeout: Optional[timedelta] = None,
+                 retry: Optional[RetryPolicy] = None, give_up=None):
         self._scheduler = scheduler
         self._coroutine = coroutine
         self._when = when
         self._task = None
         self._cancelled = False
 
-    def __lt__(self, other):
-        return self._when < other.scheduled_time()
+        self._name = name if name is not None else _job_name(coroutine)
+        self._timeout = timeout
+        self._retry = retry
+        self._give_up = give_up
 
-    def __le__(self, other):
-        return self._when <= other.scheduled_time()
+        # The job function of the current run, used for retrying, and the number of failed attempts in a row
+        self._function = None
+        self._failed_attempts = 0
 
-    def __gt__(self, other):
-        return self._when > other.scheduled_time()
+        # How long after its last successful run the job asked to run again
+        self._period = None
 
-    def __ge__(self, other):
-        return self._when >= other.scheduled_time()
+        # The [when, sequence, task] entry of this task in the scheduler's heap, or None if it is not in the heap
+        self._entry = None
 
     def _run(self):
-        # Run the task in the background
-        self._task = asyncio.create_task(self._coroutine)
+        self._function = None
+        coroutine = self._coroutine
+        if not asyncio.iscoroutine(coroutine):
+            self._function = coroutine
+            coroutine = coroutine()
+
+        # Run the task in the background, and let the scheduler know as soon as it is done
+        self._task = asyncio.create_task(self._execute(coroutine, self._when))
+        self._task.add_done_callback(lambda _: self._scheduler._task_finished(self))
         self._coroutine = None
 
+    async def _execute(self, coroutine, when):
+        # Limit the number of tasks running at once. Waiting for a turn does not count towards the timeout
+        async with self._scheduler._running_limit:
+            metrics = self._scheduler._get_metrics(self._name)
+            metrics.runs += 1
+            if when != datetime.min:
+                metrics.lateness.append(max((datetime.now() - when).total_seconds(), 0))
+
+            start = time.perf_counter()
+            try:
+                if self._timeout is None:
+                    return await coroutine
+
+                return await asyncio.wait_for(coroutine, self._timeout.total_seconds())
+            finally:
+                metrics.run_times.append(time.perf_counter() - start)
+
     # Check if the task is currently running
     def _check_running(self):
         # Gather the results of the task if it's done
         if self._task.done():
-            result = self._task.result()
-            self._task = None
+            task, self._task = self._task, None
+
+            try:
+                result = task.result()
+                self._failed_attempts = 0
+                if result is not None:
+                    self._period = result[1] - datetime.now()
+            except asyncio.CancelledError:
+                result = None
+            except Exception as e:
+                # A failing task must not take the scheduler and all the other tasks down with it
+                self._failed_attempts += 1
+                self._scheduler._get_metrics(self._name).failures += 1
+                print(f'Scheduled task {self._name} failed (attempt {self._failed_attempts}): {e!r}')
+                traceback.print_exception(type(e), e, e.__traceback__)
+
+                result = None
+                if self._function is not None and self._retry is not None and \
+                        self._failed_attempts < self._retry.max_attempts:
+                    result = self._function, datetime.now() + self._retry.delay(self._failed_attempts)
+                elif self._function is not None:
+                    # Out of retries. A recurring job carries on with its regular schedule rather than stopping
+                    self._failed_attempts = 0
+                    if self._give_up is not None:
+                        result = self._give_up(self._function)
+                    elif self._period is not None:
+                        result = self._function, datetime.now() + self._period
 
             if result is None or self._cancelled:
                 # The task is finished, do not reschedule
@@ -338,11 +544,15 @@ class LongTermTask:
         await self._task
 
     def _cleanup(self):
-        if self._coroutine is None:
+        if not asyncio.iscoroutine(self._coroutine):
             return
 
         self._coroutine.close()
 
+    # Get the name of this task, which is the name of its job unless another name was given
+    def name(self):
+        return self._name
+
     # Get the next scheduled time for this task, or None if the task won't run again
     def scheduled_time(self):
         return self._when
@@ -363,10 +573,11 @@ class LongTermTask:
     def cancel(self):
         self._cancelled = True
 
-        # If this task is in the heap, force it to the top, so it gets discarded
+        # If this task is in the heap, remove it. A running task is discarded by the scheduler once it finishes
         if not self.is_running():
-            self._when = datetime.min
-            self._scheduler.force_update()
+            self._scheduler._remove(self)
+            self._when = None
+            self._cleanup()
 
     # Reschedule the task to run at a different time. Does not work on cancelled tasks.
     # Returns True if the task was successfully rescheduled, False if the task could not be rescheduled (because it is
@@ -379,9 +590,10 @@ class LongTermTask:
         if self.is_running() or self.is_complete():
             return False
 
-        # Update the scheduled time and force update
+        # Move the task to its new place in the heap
+        self._scheduler._remove(self)
         self._when = when
-        self._scheduler.force_update()
+        self._scheduler._push(self)
         return True
 
     # Reschedule the task so that it runs As Soon As Possible
@@ -389,47 +601,287 @@ class LongTermTask:
         return self.reschedule(datetime.min)
 
 
+# Get a readable name for a job, which may be a coroutine, a function or a functools.partial
+def _job_name(job):
+    while isinstance(job, partial):
+        job = job.func
+
+    return getattr(job, '__qualname__', repr(job))
+
+
 class LongTermScheduler:
-    def __init__(self):
+    # Upper limit on how long the scheduler sleeps at once, in seconds. Sleeping is based on the event loop's clock, so
+    # waking up every now and then makes sure that changes to the system clock are noticed
+    MAX_SLEEP = 60
+
+    # Removed tasks are left in the heap as tombstones. The heap is rebuilt without them once they make up most of it
+    MIN_TOMBSTONES_TO_COMPACT = 64
+
+    # Up to max_running_tasks tasks run at once, and the others wait for their turn. Each run of a task may take at most
+    # default_timeout, unless a different timeout is given when the task is scheduled. None means no limit
+    def __init__(self, max_running_tasks: int = 4, default_timeout: Optional[timedelta] = None):
+        self._max_running_tasks = max_running_tasks
+        self._default_timeout = default_timeout
+        self._running_limit: Optional[asyncio.Semaphore] = None
+
+        # Heap of [when, sequence, task] entries. The sequence number breaks ties between tasks scheduled for the same
+        # time, so that tasks are never compared. Removed entries have their task set to None
         self._heap = []
+        self._sequence = itertools.count()
+        self._tombstones = 0
+
         self._running_tasks = []
+        self._finished_tasks = []
+
+        # Job name -> JobMetrics
+        self._metrics: Dict[str, JobMetrics] = {}
+
+        # Set to wake up the scheduler early, when the heap changes or a task finishes. Created by run(), as it must
+        # belong to the running event loop
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def _get_metrics(self, name) -> JobMetrics:
+        metrics = self._metrics.get(name)
+        if metrics is None:
+            metrics = self._metrics[name] = JobMetrics()
+
+        return metrics
+
+    # Get the metrics of every job that has run or is scheduled, by name
+    def job_metrics(self) -> Dict[str, JobMetrics]:
+        for metrics in self._metrics.values():
+            metrics.next_due = None
+
+        for when, _, task in self._heap:
+            if task is not None:
+                metrics = self._get_metrics(task.name())
+                if metrics.next_due is None or when < metrics.next_due:
+                    metrics.next_due = when
+
+        return self._metrics
+
+    # Get the number of tasks waiting for their scheduled time
+    def scheduled_count(self) -> int:
+        return len(self._heap) - self._tombstones
+
+    # Get the number of tasks which are running, or waiting for their turn to run
+    def running_count(self) -> int:
+        return len(self._running_tasks)
+
+    def _wake_up(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _task_finished(self, heap_task):
+        self._finished_tasks.append(heap_task)
+        self._wake_up()
+
+    def _push(self, task):
+        task._entry = [task.scheduled_time(), next(self._sequence), task]
+        heapq.heappush(self._heap, task._entry)
+        self._wake_up()
 
-    def force_update(self):
-        heapq.heapify(self._heap)
+    def _remove(self, task):
+        if task._entry is None:
+            return
+
+        task._entry[2] = None
+        task._entry = None
+        self._tombstones += 1
+
+        if self._tombstones >= self.MIN_TOMBSTONES_TO_COMPACT and self._tombstones * 2 > len(self._heap):
+            self._heap = [entry for entry in self._heap if entry[2] is not None]
+            heapq.heapify(self._heap)
+            self._tombstones = 0
+
+        self._wake_up()
+
+    # Get the soonest task in the heap without removing it, or None if the heap is empty
+    def _peek(self):
+        while len(self._heap) > 0 and self._heap[0][2] is None:
+            heapq.heappop(self._heap)
+            self._tombstones -= 1
+
+        return self._heap[0][2] if len(self._heap) > 0 else None
 
     async def run(self):
+        self._wakeup = asyncio.Event()
+        self._running_limit = asyncio.Semaphore(self._max_running_tasks)
         try:
             while True:
-                # Dispatch the soonest task if it is ready to be executed
-                while len(self._heap) > 0 and self._heap[0].scheduled_time() <= datetime.now():
-                    # Remove the task from the heap
-                    heap_task = heapq.heappop(self._heap)
-
-                    # Execute the task
-                    if not heap_task.cancelled():
-                        heap_task._run()
-                        self._running_tasks.append(heap_task)
+                self._wakeup.clear()
 
                 # Reschedule or remove completed tasks
-                for i, heap_task in enumerate(self._running_tasks):
-                    if heap_task._check_running():
-                        if not heap_task.is_complete():
-                            heapq.heappush(self._heap, heap_task)
+                while self._finished_tasks:
+                    heap_task = self._finished_tasks.pop(0)
+                    heap_task._check_running()
+                    if not heap_task.is_complete():
+                        self._push(heap_task)
+
+                    # The task is done running
+                    self._running_tasks.remove(heap_task)
 
-                        # The task is done running
-                        del self._running_tasks[i]
+                # Dispatch the soonest task if it is ready to be executed
+                while self._peek() is not None and self._peek().scheduled_time() <= datetime.now():
+                    # Remove the task from the heap
+                    heap_task = heapq.heappop(self._heap)[2]
+                    heap_task._entry = None
 
-                # Sleep so that other tasks may run
-                await asyncio.sleep(0.1)
+                    # Execute the task
+                    heap_task._run()
+                    self._running_tasks.append(heap_task)
+
+                # Sleep until the soonest task is ready, or until something changes
+                timeout = self.MAX_SLEEP
+                if self._peek() is not None:
+                    time_left = (self._peek().scheduled_time() - datetime.now()).total_seconds()
+                    timeout = min(max(time_left, 0), timeout)
+
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
         finally:
             # Ensure that all tasks are awaited before exiting
             await asyncio.gather(*(task._wait_until_stopped_running() for task in self._running_tasks),
                                  return_exceptions=True)
 
             # Cleanup unused coroutines
-            tuple(task._cleanup() for task in self._heap)
-
-    def schedule(self, coroutine, when):
-        task = LongTermTask(self, coroutine, when)
-        heapq.heappush(self._heap, task)
+            tuple(task._cleanup() for _, _, task in self._heap if task is not None)
+
+    # Schedule a job (a coroutine, or a function which creates one) to run at the given time. See LongTermTask
+    def schedule(self, coroutine, when, name=None, timeout: Optional[timedelta] = None,
+                 retry: Optional[RetryPolicy] = None, give_up=None):
+        task = LongTermTask(self, coroutine, when, name, timeout if timeout is not None else self._default_timeout,
+                            retry, give_up)
+        self._push(task)
         return task
+
+
+# What to do about the occurrences of a persistent job that were missed, e.g. because the bot was not running
+class CatchUp(Enum):
+    Skip = 0  # Forget about the missed occurrences
+    RunOnce = 1  # Run once for any number of missed occurrences
+    RunAll = 2  # Run every missed occurrence, one after another
+
+
+# Scheduler jobs which are stored in the fridge, so that they survive restarts. Every job has a unique name, a kind and
+# a list of JSON serializable arguments. Each kind is registered with the coroutine function that does the work, and a
+# function which finds the next occurrence of a job
+class PersistentJobs:
+    def __init__(self, scheduler: LongTermScheduler, fridge):
+        self._scheduler = scheduler
+        self._fridge = fridge
+
+        # kind -> (action, next_occurrence, catch_up, grace, timeout, retry)
+        self._kinds = {}
+
+        # name -> (kind, arguments, LongTermTask)
+        self._jobs = {}
+
+    # action(*arguments) is awaited on every occurrence of a job of this kind. next_occurrence(after, *arguments) must
+    # return the first occurrence after the given datetime, or None if the job is finished. Missed occurrences are
+    # handled according to catch_up, except that occurrences which were missed by more than grace are always skipped.
+    # timeout and retry apply to each run, as in LongTermScheduler.schedule()
+    def register(self, kind: str, action, next_occurrence, catch_up: CatchUp = CatchUp.RunOnce,
+                 grace: Optional[timedelta] = None, timeout: Optional[timedelta] = None,
+                 retry: Optional[RetryPolicy] = None):
+        self._kinds[kind] = (action, next_occurrence, catch_up, grace, timeout, retry)
+
+    # Schedule all the jobs stored in the fridge. Missed occurrences are caught up on. Must be called once, after all
+    # the job kinds have been registered
+    async def load(self):
+        for name, kind, arguments, next_run in await self._fridge.get_scheduled_jobs():
+            # Jobs of kinds which no longer exist are dropped
+            when = None
+            if kind in self._kinds:
+                when = self._next_run(kind, arguments, next_run, False)
+
+            if when is None:
+                await self._fridge.delete_scheduled_job(name)
+                continue
+
+            if when != next_run:
+                await self._fridge.save_scheduled_job(name, kind, arguments, when)
+
+            self._schedule(name, kind, arguments, when)
+
+    # Add a job, starting at its next occurrence. Does nothing if the same job already exists, so that it can be
+    # called on every startup. A different job with the same name is replaced
+    async def add(self, name: str, kind: str, *arguments):
+        arguments = list(arguments)
+
+        job = self._jobs.get(name)
+        if job is not None:
+            if job[:2] == (kind, arguments):
+                return
+
+            job[2].cancel()
+
+        when = self._kinds[kind][1](datetime.now(), *arguments)
+        if when is None:
+            await self.remove(name)
+            return
+
+        await self._fridge.save_scheduled_job(name, kind, arguments, when)
+        self._schedule(name, kind, arguments, when)
+
+    # Remove a job, so that it won't run again
+    async def remove(self, name: str):
+        job = self._jobs.pop(name, None)
+        if job is not None:
+            job[2].cancel()
+
+        await self._fridge.delete_scheduled_job(name)
+
+    def _schedule(self, name, kind, arguments, when):
+        timeout, retry = self._kinds[kind][4:]
+        task = self._scheduler.schedule(partial(self._run, name, kind, arguments, when), when, name, timeout, retry,
+                                        self._give_up)
+        self._jobs[name] = (kind, arguments, task)
+
+    # A job which keeps failing moves on to its next occurrence. The failed occurrence stays stored until the next run
+    # succeeds, so it is caught up on after a restart like any other missed occurrence
+    def _give_up(self, job):
+        name, kind, arguments, when = job.args
+        next_run = self._next_run(kind, arguments, when, True)
+        if next_run is None:
+            return None
+
+        return partial(self._run, name, kind, arguments, next_run), next_run
+
+    async def _run(self, name, kind, arguments, when):
+        job = self._jobs.get(name)
+        await self._kinds[kind][0](*arguments)
+
+        # The job may have been removed or replaced while it was running, in which case it is not ours to store anymore
+        if self._jobs.get(name) is not job:
+            return None
+
+        # Store the next occurrence, so that it is not lost if we restart
+        next_run = self._next_run(kind, arguments, when, True)
+        if next_run is None:
+            self._jobs.pop(name, None)
+            await self._fridge.delete_scheduled_job(name)
+            return None
+
+        await self._fridge.save_scheduled_job(name, kind, arguments, next_run)
+        return partial(self._run, name, kind, arguments, next_run), next_run
+
+    # Find when a job should run next, starting from the occurrence at the given time. If the job just ran, that
+    # occurrence is done with. Past occurrences are skipped according to the catch-up policy of the kind
+    def _next_run(self, kind, arguments, when, just_ran):
+        _, next_occurrence, catch_up, grace, _, _ = self._kinds[kind]
+        if just_ran:
+            when = next_occurrence(when, *arguments)
+
+        now = datetime.now()
+        while when is not None and when <= now:
+            if catch_up == CatchUp.RunAll and (grace is None or now - when <= grace):
+                break
+            if catch_up == CatchUp.RunOnce and not just_ran and (grace is None or now - when <= grace):
+                break
+
+            when = next_occurrence(when, *arguments)
+
+        return when